@@ -0,0 +1,128 @@
+"""Silence trimming and splitting for long recordings before they go to Whisper.
+
+Works on the PCM WAV rendition Twilio serves for every recording (MP3 would
+need a decoder we don't ship). Loudness is measured as RMS over short
+frames; the noise floor is estimated per recording, so the same thresholds
+work for quiet and loud lines. Splits land on the quietest stretch near each
+target chunk boundary, so words are not cut in half.
+"""
+import io
+import os
+import wave
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+
+FRAME_MS = 20
+CHUNK_TARGET_SECONDS = float(os.getenv("TRANSCRIPTION_CHUNK_SECONDS", "30"))
+# How far either side of the target boundary to look for a pause
+CHUNK_SEARCH_SECONDS = float(os.getenv("TRANSCRIPTION_CHUNK_SEARCH_SECONDS", "8"))
+# Padding kept around trimmed speech so the first/last syllables survive
+TRIM_PADDING_SECONDS = 0.3
+# Frames quieter than max(noise floor * ratio, floor) count as silence
+SILENCE_RATIO = 2.5
+SILENCE_RMS_FLOOR = 150  # 16-bit sample units
+
+
+class Pcm(NamedTuple):
+    samples: np.ndarray  # int16, mono
+    rate: int
+
+    @property
+    def duration(self) -> float:
+        return len(self.samples) / self.rate
+
+
+class Chunk(NamedTuple):
+    start: float  # seconds into the original recording
+    end: float
+    wav: bytes
+
+
+def read_wav(data: bytes) -> Pcm:
+    """Decode 16-bit PCM WAV, downmixing multi-channel (dual-channel call recordings) to mono"""
+    with wave.open(io.BytesIO(data)) as w:
+        if w.getsampwidth() != 2:
+            raise ValueError(f"Unsupported WAV sample width: {w.getsampwidth()}")
+        channels = w.getnchannels()
+        rate = w.getframerate()
+        samples = np.frombuffer(w.readframes(w.getnframes()), dtype="<i2")
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1).astype(np.int16)
+    return Pcm(samples, rate)
+
+
+def encode_wav(samples: np.ndarray, rate: int) -> bytes:
+    out = io.BytesIO()
+    with wave.open(out, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(samples.astype("<i2").tobytes())
+    return out.getvalue()
+
+
+def frame_rms(pcm: Pcm) -> np.ndarray:
+    frame = max(1, pcm.rate * FRAME_MS // 1000)
+    usable = len(pcm.samples) // frame * frame
+    if not usable:
+        return np.zeros(0)
+    frames = pcm.samples[:usable].astype(np.float32).reshape(-1, frame)
+    return np.sqrt(np.mean(frames * frames, axis=1))
+
+
+def silence_threshold(rms: np.ndarray) -> float:
+    noise_floor = float(np.percentile(rms, 10)) if len(rms) else 0.0
+    return max(noise_floor * SILENCE_RATIO, SILENCE_RMS_FLOOR)
+
+
+def speech_bounds(rms: np.ndarray, threshold: float) -> Tuple[int, int]:
+    """First and one-past-last frame above the silence threshold, or (0, 0) if all silent"""
+    voiced = np.flatnonzero(rms > threshold)
+    if not len(voiced):
+        return 0, 0
+    return int(voiced[0]), int(voiced[-1]) + 1
+
+
+def _split_frames(rms: np.ndarray, start: int, end: int) -> List[int]:
+    """Frame indices to cut at: the quietest 200 ms window around every target boundary"""
+    per_second = 1000 // FRAME_MS
+    target = max(1, int(CHUNK_TARGET_SECONDS * per_second))
+    # Keep every cut at least half a target past the previous one: a search window reaching
+    # back to the previous cut (TRANSCRIPTION_CHUNK_SEARCH_SECONDS >= _CHUNK_SECONDS) would never advance
+    search = min(int(CHUNK_SEARCH_SECONDS * per_second), target // 2)
+    window = max(1, 200 // FRAME_MS)
+    smoothed = np.convolve(rms, np.ones(window) / window, mode="same")
+
+    cuts = []
+    position = start
+    while end - position > target + search:
+        lo = position + target - search
+        hi = position + target + search + 1
+        cut = lo + int(np.argmin(smoothed[lo:hi]))
+        cuts.append(cut)
+        position = cut
+    return cuts
+
+
+def plan_chunks(pcm: Pcm) -> List[Chunk]:
+    """Trim leading/trailing silence and cut the rest into ~CHUNK_TARGET_SECONDS pieces at pauses.
+
+    Returns an empty list when the recording is silence throughout.
+    """
+    rms = frame_rms(pcm)
+    first, last = speech_bounds(rms, silence_threshold(rms))
+    if first == last:
+        return []
+
+    frame = pcm.rate * FRAME_MS // 1000
+    pad = int(TRIM_PADDING_SECONDS * 1000 // FRAME_MS)
+    first = max(0, first - pad)
+    last = min(len(rms), last + pad)
+
+    bounds = [first] + _split_frames(rms, first, last) + [last]
+    chunks = []
+    for a, b in zip(bounds, bounds[1:]):
+        segment = pcm.samples[a * frame:b * frame]
+        chunks.append(Chunk(a * FRAME_MS / 1000, b * FRAME_MS / 1000, encode_wav(segment, pcm.rate)))
+    return chunks
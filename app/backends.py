@@ -0,0 +1,256 @@
+"""Speech-to-text backends the transcription pipeline can route a recording to.
+
+  openai - hosted Whisper API (AsyncOpenAI), paced by the shared adaptive rate limiter
+  local  - faster-whisper (CTranslate2) on this machine's CPU, in a process pool
+           so decoding never holds the GIL the web workers need
+           (optional: pip install faster-whisper)
+  fake   - deterministic text without any model, for tests and load tests
+
+Which backend serves a recording: the scenario's transcription_backend if set,
+else TRANSCRIPTION_SHORT_BACKEND for recordings of at most
+TRANSCRIPTION_SHORT_MAX_SECONDS (short answers skip the upload and per-minute
+cost), else TRANSCRIPTION_BACKEND.
+"""
+import asyncio
+import hashlib
+import importlib.util
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, NamedTuple, Optional
+
+from openai import AsyncOpenAI, RateLimitError
+
+from .ratelimit import AdaptiveRateLimiter, retry_after_seconds
+
+TRANSCRIPTION_BACKEND = os.getenv("TRANSCRIPTION_BACKEND", "openai")
+TRANSCRIPTION_SHORT_BACKEND = os.getenv("TRANSCRIPTION_SHORT_BACKEND")  # e.g. "local"; unset to disable
+TRANSCRIPTION_SHORT_MAX_SECONDS = float(os.getenv("TRANSCRIPTION_SHORT_MAX_SECONDS", "15"))
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+WHISPER_TIMEOUT = float(os.getenv("WHISPER_TIMEOUT", "120"))
+WHISPER_CONCURRENCY = int(os.getenv("TRANSCRIPTION_CONCURRENCY", "8"))
+WHISPER_MODEL = "whisper-1"
+WHISPER_LANGUAGE = "ja"
+
+# Whisper pacing: start at WHISPER_RATE_PER_MINUTE, creep up by WHISPER_RATE_INCREASE per
+# success (up to WHISPER_RATE_MAX_PER_MINUTE), halve on every 429.
+# The defaults match OpenAI's usage tier 1 limit for whisper-1 (500 requests/minute); set
+# both to your organisation's limit on higher tiers. After a 429 halves the rate, the step
+# of 5 per success climbs back to the limit within about fifty requests.
+WHISPER_RATE_PER_MINUTE = float(os.getenv("WHISPER_RATE_PER_MINUTE", "500"))
+WHISPER_RATE_MIN_PER_MINUTE = float(os.getenv("WHISPER_RATE_MIN_PER_MINUTE", "3"))
+WHISPER_RATE_MAX_PER_MINUTE = float(os.getenv("WHISPER_RATE_MAX_PER_MINUTE", "500"))
+WHISPER_RATE_BURST = int(os.getenv("WHISPER_RATE_BURST", "10"))
+WHISPER_RATE_INCREASE = float(os.getenv("WHISPER_RATE_INCREASE", "5"))
+WHISPER_RATE_LIMIT_COOLDOWN = float(os.getenv("WHISPER_RATE_LIMIT_COOLDOWN", "5"))  # when 429 has no Retry-After
+# A 429 asking for a longer wait than this hands the job back to the queue instead of holding a worker
+WHISPER_RATE_LIMIT_MAX_INLINE_WAIT = float(os.getenv("WHISPER_RATE_LIMIT_MAX_INLINE_WAIT", "60"))
+WHISPER_RATE_LIMIT_RETRIES = int(os.getenv("WHISPER_RATE_LIMIT_RETRIES", "5"))
+
+LOCAL_WHISPER_MODEL = os.getenv("LOCAL_WHISPER_MODEL", "small")
+LOCAL_WHISPER_COMPUTE_TYPE = os.getenv("LOCAL_WHISPER_COMPUTE_TYPE", "int8")
+LOCAL_WHISPER_PROCESSES = int(os.getenv("LOCAL_WHISPER_PROCESSES", "2"))
+LOCAL_WHISPER_CPU_THREADS = int(os.getenv("LOCAL_WHISPER_CPU_THREADS", "2"))  # per process
+
+
+class TranscriptionError(Exception):
+    """A transcription attempt failed; the job queue decides whether to retry it"""
+
+    def __init__(self, message: str, audio_bytes: int = 0):
+        super().__init__(message)
+        self.audio_bytes = audio_bytes
+        self.backend: Optional["TranscriptionBackend"] = None  # set once routing has picked one
+
+
+class RateLimited(TranscriptionError):
+    """Whisper kept answering 429; retry the job after `retry_after` seconds without counting an attempt"""
+
+    def __init__(self, message: str, retry_after: float, audio_bytes: int = 0):
+        super().__init__(message, audio_bytes)
+        self.retry_after = retry_after
+
+
+class BackendTranscript(NamedTuple):
+    text: str
+    audio_duration: float  # seconds, 0 when the backend doesn't report it
+
+
+class TranscriptionBackend:
+    name = ""
+    service = ""  # TranscriptionLog.service for transcripts this backend produced
+    model_name = ""  # part of the transcript cache key
+
+    async def transcribe(self, audio, response_format: str = "json") -> BackendTranscript:
+        """Transcribe an AudioBuffer (filename, file, size); raises TranscriptionError or the client's errors"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class OpenAIBackend(TranscriptionBackend):
+    """The hosted Whisper API.
+
+    The client and semaphore belong to the event loop they were created on,
+    so they are (re)built lazily the first time a new loop uses the backend.
+    """
+    name = "openai"
+    service = "openai_whisper"
+    model_name = WHISPER_MODEL
+
+    def __init__(self, concurrency: int, limiter: AdaptiveRateLimiter):
+        self.concurrency = concurrency
+        self.limiter = limiter
+        self._loop = None
+        self._semaphore = None
+        self._client = None
+
+    def _bind(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            # 429s are retried by the shared limiter, not by each request on its own
+            self._client = AsyncOpenAI(
+                api_key=OPENAI_API_KEY, timeout=WHISPER_TIMEOUT, max_retries=0
+            ) if OPENAI_API_KEY else None
+
+    async def transcribe(self, audio, response_format: str = "json") -> BackendTranscript:
+        """One Whisper request, paced by the limiter and retried on 429 (raises RateLimited when it gives up)"""
+        if not OPENAI_API_KEY:
+            raise TranscriptionError("OpenAI API key not configured")
+        self._bind()
+        for attempt in range(WHISPER_RATE_LIMIT_RETRIES + 1):
+            await self.limiter.acquire()
+            audio.file.seek(0)
+            try:
+                async with self._semaphore:
+                    transcript = await self._client.audio.transcriptions.create(
+                        model=WHISPER_MODEL,
+                        file=(audio.filename, audio.file),
+                        language=WHISPER_LANGUAGE,
+                        response_format=response_format
+                    )
+            except RateLimitError as e:
+                if e.code == "insufficient_quota":
+                    raise  # billing, not pacing: waiting won't help
+                cooldown = self.limiter.on_rate_limited(retry_after_seconds(e.response.headers))
+                print(f"Whisper rate limited ({audio.filename}), rate now {self.limiter.rate:.1f}/min, pausing {cooldown:.1f}s")
+                if cooldown > WHISPER_RATE_LIMIT_MAX_INLINE_WAIT or attempt == WHISPER_RATE_LIMIT_RETRIES:
+                    raise RateLimited(str(e), cooldown, audio.size) from e
+                continue
+            self.limiter.on_success()
+            # verbose_json carries the duration; plain json doesn't
+            return BackendTranscript(transcript.text, getattr(transcript, "duration", 0) or 0)
+
+
+# --- Local CPU model (runs in the pool's worker processes) ---
+_local_model = None
+
+
+def _load_local_model(model_name: str, compute_type: str, cpu_threads: int):
+    global _local_model
+    from faster_whisper import WhisperModel
+    _local_model = WhisperModel(model_name, device="cpu", compute_type=compute_type, cpu_threads=cpu_threads)
+
+
+def _run_local_model(audio: bytes, language: str):
+    segments, info = _local_model.transcribe(io.BytesIO(audio), language=language)
+    # Japanese segments join without spaces, like the API's output
+    return "".join(segment.text.strip() for segment in segments), info.duration
+
+
+class LocalWhisperBackend(TranscriptionBackend):
+    """faster-whisper in a pool of `processes` worker processes, each holding its own copy of the model"""
+    name = "local"
+    service = "local_whisper"
+
+    def __init__(self, model: str, compute_type: str, processes: int, cpu_threads: int):
+        self.model = model
+        self.compute_type = compute_type
+        self.processes = processes
+        self.cpu_threads = cpu_threads
+        self.model_name = f"faster-whisper-{model}"
+        self._pool = None
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            if importlib.util.find_spec("faster_whisper") is None:
+                raise TranscriptionError("Local transcription needs the faster-whisper package")
+            # spawn: forking a process that runs an event loop and DB pools is asking for trouble
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_load_local_model,
+                initargs=(self.model, self.compute_type, self.cpu_threads),
+            )
+        return self._pool
+
+    async def transcribe(self, audio, response_format: str = "json") -> BackendTranscript:
+        pool = self._executor()
+        audio.file.seek(0)
+        data = audio.file.read()
+        try:
+            text, duration = await asyncio.get_running_loop().run_in_executor(
+                pool, _run_local_model, data, WHISPER_LANGUAGE
+            )
+        except BrokenProcessPool as e:
+            # A worker died or the model failed to load; drop the pool so the job's next attempt builds a fresh one
+            if self._pool is pool:
+                pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+            raise TranscriptionError(f"Local whisper pool broke: {e}", audio.size) from e
+        return BackendTranscript(text, duration)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+class FakeBackend(TranscriptionBackend):
+    """Same audio in, same text out; no model, no network"""
+    name = "fake"
+    service = "fake"
+    model_name = "fake"
+
+    async def transcribe(self, audio, response_format: str = "json") -> BackendTranscript:
+        audio.file.seek(0)
+        digest = hashlib.sha256(audio.file.read()).hexdigest()
+        return BackendTranscript(f"(fake transcript {digest[:12]})", 0)
+
+
+whisper_limiter = AdaptiveRateLimiter(
+    "whisper", WHISPER_RATE_PER_MINUTE, WHISPER_RATE_MIN_PER_MINUTE, WHISPER_RATE_MAX_PER_MINUTE,
+    WHISPER_RATE_BURST, WHISPER_RATE_INCREASE, WHISPER_RATE_LIMIT_COOLDOWN,
+)
+
+BACKENDS: Dict[str, TranscriptionBackend] = {
+    backend.name: backend for backend in (
+        OpenAIBackend(WHISPER_CONCURRENCY, whisper_limiter),
+        LocalWhisperBackend(LOCAL_WHISPER_MODEL, LOCAL_WHISPER_COMPUTE_TYPE, LOCAL_WHISPER_PROCESSES, LOCAL_WHISPER_CPU_THREADS),
+        FakeBackend(),
+    )
+}
+
+
+def choose_backend(scenario_backend: Optional[str], duration: Optional[float]) -> TranscriptionBackend:
+    """Scenario override, then the short-recording rule, then the default"""
+    if scenario_backend:
+        name = scenario_backend
+    elif TRANSCRIPTION_SHORT_BACKEND and duration is not None and duration <= TRANSCRIPTION_SHORT_MAX_SECONDS:
+        name = TRANSCRIPTION_SHORT_BACKEND
+    else:
+        name = TRANSCRIPTION_BACKEND
+    backend = BACKENDS.get(name)
+    if backend is None:
+        raise TranscriptionError(f"Unknown transcription backend: {name}")
+    return backend
+
+
+def close_backends():
+    for backend in BACKENDS.values():
+        backend.close()
@@ -0,0 +1,202 @@
+"""In-process caches for the Twilio webhook hot path.
+
+Each worker process keeps its own copy. The admin write endpoints invalidate
+the entries they touch, but only in the process that served the write; every
+other process (more workers, more dynos) picks the change up when its entry
+expires. Entries therefore carry a TTL: PHONE_CACHE_TTL / SCENARIO_CACHE_TTL
+bound how long a routing or call-flow change can take to reach every
+process, and PHONE_CACHE_NEGATIVE_TTL keeps "not registered" answers short,
+so a number that was called before it was registered starts working quickly.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+from sqlalchemy.orm import Session
+
+from . import models
+
+PHONE_CACHE_SIZE = int(os.getenv("PHONE_CACHE_SIZE", "10000"))
+PHONE_CACHE_TTL = float(os.getenv("PHONE_CACHE_TTL", "60"))
+PHONE_CACHE_NEGATIVE_TTL = float(os.getenv("PHONE_CACHE_NEGATIVE_TTL", "5"))
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Small thread-safe LRU map with per-entry expiry (webhooks run on the threadpool as well as the loop)"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # key -> (value, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            value, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = float("inf")):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# --- Phone number -> scenario routing ---
+class ResolvedNumber(NamedTuple):
+    scenario_id: Optional[int]
+    is_active: bool  # scenario.is_active at resolution time
+
+
+_phone_cache = LRUCache(PHONE_CACHE_SIZE)
+
+
+def resolve_phone_number(db: Session, to_number: str) -> Optional[ResolvedNumber]:
+    """Map an inbound To number to its scenario, or None if it is not registered.
+
+    Unknown numbers are cached too, briefly, so repeated calls to a stale number stay cheap.
+    """
+    key = models.normalize_phone(to_number)
+    cached = _phone_cache.get(key, _MISSING)
+    if cached is not _MISSING:
+        return cached
+
+    phone_entry = db.query(models.PhoneNumber).filter(models.PhoneNumber.normalized_number == key).first()
+    resolved = None
+    if phone_entry:
+        scenario = phone_entry.scenario
+        resolved = ResolvedNumber(
+            scenario_id=phone_entry.scenario_id,
+            is_active=bool(scenario and scenario.is_active),
+        )
+    _phone_cache.set(key, resolved, PHONE_CACHE_TTL if resolved else PHONE_CACHE_NEGATIVE_TTL)
+    return resolved
+
+
+def invalidate_phone_number(to_number: str):
+    _phone_cache.pop(models.normalize_phone(to_number))
+
+
+def invalidate_all_phone_numbers():
+    """Scenario changes (activation, deletion) affect every number pointing at it"""
+    _phone_cache.clear()
+
+
+# --- Compiled call flow per scenario ---
+SCENARIO_CACHE_SIZE = int(os.getenv("SCENARIO_CACHE_SIZE", "256"))
+SCENARIO_CACHE_TTL = float(os.getenv("SCENARIO_CACHE_TTL", "30"))
+
+
+class CompiledQuestion(NamedTuple):
+    id: int
+    text: str
+    sort_order: int
+    is_active: bool
+
+
+class CompiledScenario(NamedTuple):
+    """Immutable snapshot of everything the webhooks read for one scenario"""
+    id: int
+    version: int
+    name: str
+    is_active: bool
+    greeting_text: Optional[str]
+    disclaimer_text: Optional[str]
+    question_guidance_text: Optional[str]
+    questions: tuple  # active questions ordered by sort_order
+    questions_by_id: dict  # every question, including inactive ones answered mid-call
+    ending_guidances: tuple  # texts ordered by sort_order
+
+    def first_question(self) -> Optional[CompiledQuestion]:
+        return self.questions[0] if self.questions else None
+
+    def get_question(self, question_id: int) -> Optional[CompiledQuestion]:
+        return self.questions_by_id.get(question_id)
+
+    def next_question(self, current: CompiledQuestion) -> Optional[CompiledQuestion]:
+        for question in self.questions:
+            if question.sort_order > current.sort_order:
+                return question
+        return None
+
+
+_scenario_cache = LRUCache(SCENARIO_CACHE_SIZE)
+_scenario_versions = {}
+_versions_lock = threading.Lock()
+
+
+def _current_version(scenario_id: int) -> int:
+    with _versions_lock:
+        return _scenario_versions.get(scenario_id, 0)
+
+
+def _compile_scenario(db: Session, scenario_id: int, version: int) -> Optional[CompiledScenario]:
+    scenario = db.query(models.Scenario).get(scenario_id)
+    if not scenario:
+        return None
+
+    questions = db.query(models.Question).filter(
+        models.Question.scenario_id == scenario_id
+    ).order_by(models.Question.sort_order).all()
+    compiled_questions = [
+        CompiledQuestion(id=q.id, text=q.text, sort_order=q.sort_order or 0, is_active=bool(q.is_active))
+        for q in questions
+    ]
+    ending_guidances = db.query(models.EndingGuidance).filter(
+        models.EndingGuidance.scenario_id == scenario_id
+    ).order_by(models.EndingGuidance.sort_order).all()
+
+    return CompiledScenario(
+        id=scenario.id,
+        version=version,
+        name=scenario.name,
+        is_active=bool(scenario.is_active),
+        greeting_text=scenario.greeting_text,
+        disclaimer_text=scenario.disclaimer_text,
+        question_guidance_text=scenario.question_guidance_text,
+        questions=tuple(q for q in compiled_questions if q.is_active),
+        questions_by_id={q.id: q for q in compiled_questions},
+        ending_guidances=tuple(eg.text for eg in ending_guidances),
+    )
+
+
+def get_compiled_scenario(db: Session, scenario_id: int) -> Optional[CompiledScenario]:
+    """Return the cached call flow for a scenario, compiling it on first use"""
+    version = _current_version(scenario_id)
+    cached = _scenario_cache.get(scenario_id)
+    if cached is not None and cached.version == version:
+        return cached
+
+    compiled = _compile_scenario(db, scenario_id, version)
+    # An admin write may have landed while we were reading; don't cache a stale snapshot
+    if compiled is not None and _current_version(scenario_id) == version:
+        _scenario_cache.set(scenario_id, compiled, SCENARIO_CACHE_TTL)
+    return compiled
+
+
+def invalidate_scenario(scenario_id: int):
+    with _versions_lock:
+        _scenario_versions[scenario_id] = _scenario_versions.get(scenario_id, 0) + 1
+    _scenario_cache.pop(scenario_id)
@@ -0,0 +1,108 @@
+"""Twilio call-status events, coalesced into batched `calls` updates.
+
+/twilio/status_callback only buffers the event; a write-behind flusher merges
+everything buffered per CallSid (a call's ringing/in-progress/completed
+events collapse into one row update) and applies the lot in one transaction.
+A final status (completed, busy, ...) is never overwritten by a late
+in-progress event, whatever order Twilio's callbacks arrive in.
+"""
+import os
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, NamedTuple, Optional, Sequence
+
+from sqlalchemy import Integer, bindparam, func
+
+from . import models
+from .database import SessionLocal
+from .writebehind import WriteBehindBuffer
+
+CALL_STATUS_BATCH_SIZE = int(os.getenv("CALL_STATUS_BATCH_SIZE", "200"))
+CALL_STATUS_FLUSH_INTERVAL = float(os.getenv("CALL_STATUS_FLUSH_INTERVAL", "1"))
+CALL_STATUS_MAX_PENDING = int(os.getenv("CALL_STATUS_MAX_PENDING", "5000"))
+
+FINAL_STATUSES = ("completed", "busy", "no-answer", "failed", "canceled")
+
+
+class CallStatusEvent(NamedTuple):
+    call_sid: str
+    status: Optional[str] = None
+    duration: Optional[int] = None  # seconds, sent with the final status
+    ended_at: Optional[datetime] = None
+    recording_sid: Optional[str] = None
+
+
+def parse_timestamp(value: Optional[str]) -> Optional[datetime]:
+    """Twilio's RFC 2822 Timestamp parameter as naive UTC (how the calls table stores times)"""
+    if not value:
+        return None
+    try:
+        parsed = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def coalesce(events: Sequence[CallStatusEvent]) -> Dict[str, CallStatusEvent]:
+    """One event per call: final status beats non-final, later beats earlier, fields fill in"""
+    merged: Dict[str, CallStatusEvent] = {}
+    for event in events:
+        current = merged.get(event.call_sid)
+        if current is None:
+            merged[event.call_sid] = event
+            continue
+        status = current.status
+        if event.status and (status not in FINAL_STATUSES or event.status in FINAL_STATUSES):
+            status = event.status
+        merged[event.call_sid] = CallStatusEvent(
+            event.call_sid,
+            status,
+            event.duration if event.duration is not None else current.duration,
+            event.ended_at or current.ended_at,
+            current.recording_sid or event.recording_sid,
+        )
+    return merged
+
+
+_calls = models.Call.__table__
+
+# One executemany per statement for the whole batch
+_final_update = _calls.update().where(_calls.c.call_sid == bindparam("b_call_sid")).values(
+    status=bindparam("b_status"),
+    ended_at=bindparam("b_ended_at"),
+    duration=func.coalesce(bindparam("b_duration", type_=Integer), _calls.c.duration),
+)
+_progress_update = _calls.update().where(
+    _calls.c.call_sid == bindparam("b_call_sid"), _calls.c.status.notin_(FINAL_STATUSES),
+).values(status=bindparam("b_status"))
+_recording_update = _calls.update().where(
+    _calls.c.call_sid == bindparam("b_call_sid"), _calls.c.recording_sid.is_(None),
+).values(recording_sid=bindparam("b_recording_sid"))
+
+
+def write_events(events: Sequence[CallStatusEvent]):
+    final, progress, recordings = [], [], []
+    for event in coalesce(events).values():
+        if event.status in FINAL_STATUSES:
+            final.append({"b_call_sid": event.call_sid, "b_status": event.status,
+                          "b_ended_at": event.ended_at or datetime.utcnow(), "b_duration": event.duration})
+        elif event.status:
+            progress.append({"b_call_sid": event.call_sid, "b_status": event.status})
+        if event.recording_sid:
+            recordings.append({"b_call_sid": event.call_sid, "b_recording_sid": event.recording_sid})
+
+    db = SessionLocal()
+    try:
+        for statement, params in ((_final_update, final), (_progress_update, progress), (_recording_update, recordings)):
+            if params:
+                db.execute(statement, params)
+        db.commit()
+    finally:
+        db.close()
+
+
+buffer = WriteBehindBuffer(
+    "call status", write_events, CALL_STATUS_BATCH_SIZE, CALL_STATUS_FLUSH_INTERVAL, CALL_STATUS_MAX_PENDING,
+)
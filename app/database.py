@@ -1,13 +1,118 @@
-from sqlalchemy import create_engine
+import os
+import threading
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./app.db"
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./app.db")
+# Render/Heroku hand out postgres:// URLs, which SQLAlchemy no longer accepts
+if SQLALCHEMY_DATABASE_URL.startswith("postgres://"):
+    SQLALCHEMY_DATABASE_URL = "postgresql://" + SQLALCHEMY_DATABASE_URL[len("postgres://"):]
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+# SQLite
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+# Pooled servers (Postgres)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets webhook reads proceed while a transcription commit is writing;
+    # busy_timeout waits for the write lock instead of failing with "database is locked"
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.close()
+
+
+def make_engine(url: str, tune_sqlite: bool = True):
+    """Engine for `url`: tuned SQLite for local/small deploys, a pre-pinged pool for Postgres"""
+    if url.startswith("sqlite"):
+        engine = create_engine(
+            url, connect_args={"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000}
+        )
+        if tune_sqlite:
+            event.listen(engine, "connect", _apply_sqlite_pragmas)
+        return engine
+
+    return create_engine(
+        url,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
+
+
+class SQLiteWriteGate:
+    """Queue write transactions from this process on a lock before they reach SQLite.
+
+    SQLite has a single writer. Threads that lose the race otherwise sit in
+    SQLite's busy handler, which polls with growing sleeps and turns bursts of
+    concurrent webhook commits into multi-second tail latencies. The lock is
+    taken at the first write of a transaction and released when it ends.
+
+    Limits:
+    - It is one lock for the whole process, held for the rest of the
+      transaction. A slow write transaction makes every webhook writer wait
+      behind it for up to `timeout`, after which they proceed without the
+      gate (and meet SQLite's busy handler instead). Long admin writes must
+      therefore commit in short batches (bulk retranscription does), and
+      should do their reads before their first write (/stats/rebuild does).
+    - A second session writing in the thread that already holds the lock
+      skips the gate rather than waiting on itself; SQLite's own locking
+      still applies between the two.
+    - It only orders writers within one process; other processes still
+      contend through busy_timeout.
+    """
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._owner = None  # thread ident holding the lock
+
+    def install(self, session_factory):
+        event.listen(session_factory, "before_flush", self._before_flush)
+        event.listen(session_factory, "do_orm_execute", self._do_orm_execute)
+        event.listen(session_factory, "after_transaction_end", self._after_transaction_end)
+
+    def _acquire(self, session):
+        if "sqlite_write_gate" in session.info:
+            return
+        if self._owner == threading.get_ident():
+            session.info["sqlite_write_gate"] = False
+            return
+        # On timeout fall back to SQLite's own locking
+        acquired = self._lock.acquire(timeout=self.timeout)
+        if acquired:
+            self._owner = threading.get_ident()
+        session.info["sqlite_write_gate"] = acquired
+
+    def _before_flush(self, session, flush_context, instances):
+        self._acquire(session)
+
+    def _do_orm_execute(self, orm_execute_state):
+        if not orm_execute_state.is_select:
+            self._acquire(orm_execute_state.session)
+
+    def _after_transaction_end(self, session, transaction):
+        if transaction.parent is None and session.info.pop("sqlite_write_gate", False):
+            self._owner = None
+            self._lock.release()
+
+
+engine = make_engine(SQLALCHEMY_DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+if engine.dialect.name == "sqlite":
+    SQLiteWriteGate(SQLITE_BUSY_TIMEOUT_MS / 1000).install(SessionLocal)
 
 Base = declarative_base()
 
@@ -0,0 +1,369 @@
+"""Durable transcription job queue backed by the transcription_jobs table.
+
+Webhooks enqueue a job in the same transaction as the Answer/Message row, so
+pending work survives deploys and restarts. Workers claim due jobs by taking a
+lease with a conditional UPDATE (safe across processes and dynos); if a worker
+dies mid-job its lease expires and another worker picks the job up again.
+Failed attempts are retried with exponential backoff until max_attempts, after
+which the answer/message is marked failed.
+
+Successful results go through a write-behind buffer: transcripts, their logs
+and the job completions are committed together in batches rather than as two
+small transactions per transcript. A result lost before its batch commits
+(crash, failed write) leaves the job running, so it is retried when the
+lease expires.
+"""
+import asyncio
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional, Sequence
+
+from sqlalchemy import and_, exists, func, or_, update
+from sqlalchemy.orm import Session
+
+from . import metrics, models
+from .database import SessionLocal
+from .transcription import (
+    RateLimited, TranscriptResult, transcribe_answer, transcribe_message, mark_answer_failed, mark_message_failed,
+    save_transcripts, prune_transcription_cache,
+)
+from .writebehind import WriteBehindBuffer
+
+TRANSCRIPTION_WORKERS = int(os.getenv("TRANSCRIPTION_WORKERS", "8"))
+JOB_LEASE_SECONDS = int(os.getenv("TRANSCRIPTION_JOB_LEASE_SECONDS", "600"))
+JOB_MAX_ATTEMPTS = int(os.getenv("TRANSCRIPTION_JOB_MAX_ATTEMPTS", "5"))
+JOB_RETRY_BASE_SECONDS = int(os.getenv("TRANSCRIPTION_JOB_RETRY_BASE_SECONDS", "30"))
+JOB_RETRY_MAX_SECONDS = int(os.getenv("TRANSCRIPTION_JOB_RETRY_MAX_SECONDS", "3600"))
+JOB_POLL_INTERVAL = float(os.getenv("TRANSCRIPTION_JOB_POLL_INTERVAL", "5"))
+JOB_RETENTION_DAYS = int(os.getenv("TRANSCRIPTION_JOB_RETENTION_DAYS", "7"))
+RESULT_BATCH_SIZE = int(os.getenv("TRANSCRIPTION_RESULT_BATCH_SIZE", "50"))
+RESULT_FLUSH_INTERVAL = float(os.getenv("TRANSCRIPTION_RESULT_FLUSH_INTERVAL", "1"))
+RESULT_MAX_PENDING = int(os.getenv("TRANSCRIPTION_RESULT_MAX_PENDING", "500"))
+CACHE_PRUNE_INTERVAL = float(os.getenv("TRANSCRIPT_CACHE_PRUNE_INTERVAL", "3600"))
+
+ACTIVE_STATUSES = ("pending", "running")
+
+Job = models.TranscriptionJob
+
+
+class ClaimedJob(NamedTuple):
+    id: int
+    kind: str
+    target_id: int
+    recording_sid: str
+    attempts: int
+    max_attempts: int
+    force: bool
+    recording_duration: Optional[int]
+
+
+class FinishedJob(NamedTuple):
+    job_id: int
+    worker_id: str
+    result: TranscriptResult
+
+
+# --- Queue operations (sync, run on a thread from the workers) ---
+def enqueue_transcription(db: Session, kind: str, target_id: int, recording_sid: str,
+                          run_at: Optional[datetime] = None, force: bool = False,
+                          batch_id: Optional[int] = None,
+                          recording_duration: Optional[int] = None) -> models.TranscriptionJob:
+    """Add a job to the caller's session; it becomes visible when the caller commits.
+
+    `force` makes the job call Whisper even if a cached transcript of the same audio exists.
+    """
+    job = models.TranscriptionJob(
+        kind=kind,
+        target_id=target_id,
+        recording_sid=recording_sid,
+        status="pending",
+        force=force,
+        batch_id=batch_id,
+        recording_duration=recording_duration,
+        attempts=0,
+        max_attempts=JOB_MAX_ATTEMPTS,
+        next_run_at=run_at or datetime.utcnow(),
+    )
+    db.add(job)
+    return job
+
+
+def _claimable(now: datetime):
+    return or_(
+        and_(Job.status == "pending", Job.next_run_at <= now),
+        and_(Job.status == "running", Job.locked_until < now),  # lease expired, worker presumably gone
+    )
+
+
+def claim_job(worker_id: str) -> Optional[ClaimedJob]:
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        candidates = db.query(Job.id).filter(_claimable(now)).order_by(Job.next_run_at).limit(5).all()
+        for (job_id,) in candidates:
+            # Another worker may have taken it since the SELECT; the WHERE re-check makes this atomic
+            result = db.execute(
+                update(Job)
+                .where(Job.id == job_id, _claimable(now))
+                .values(
+                    status="running",
+                    locked_by=worker_id,
+                    locked_until=now + timedelta(seconds=JOB_LEASE_SECONDS),
+                    attempts=Job.attempts + 1,
+                    updated_at=now,
+                )
+            )
+            if result.rowcount == 1:
+                db.commit()
+                job = db.query(Job).get(job_id)
+                return ClaimedJob(
+                    job.id, job.kind, job.target_id, job.recording_sid, job.attempts, job.max_attempts,
+                    bool(job.force), job.recording_duration,
+                )
+        db.rollback()
+        return None
+    finally:
+        db.close()
+
+
+def _finish_job(job_id: int, worker_id: str, **values):
+    db = SessionLocal()
+    try:
+        # Only the lease holder may finish the job
+        db.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.locked_by == worker_id)
+            .values(locked_by=None, locked_until=None, updated_at=datetime.utcnow(), **values)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+_last_cache_prune = time.monotonic()
+
+
+def commit_finished_jobs(finished: Sequence[FinishedJob]):
+    """Store a batch of transcripts and mark their jobs completed in one transaction"""
+    global _last_cache_prune
+    db = SessionLocal()
+    try:
+        save_transcripts(db, [f.result for f in finished])
+        # Piggyback cache eviction on an occasional batch rather than running another loop
+        if time.monotonic() - _last_cache_prune > CACHE_PRUNE_INTERVAL:
+            _last_cache_prune = time.monotonic()
+            prune_transcription_cache(db)
+        now = datetime.utcnow()
+        for f in finished:
+            db.execute(
+                update(Job)
+                .where(Job.id == f.job_id, Job.locked_by == f.worker_id)
+                .values(status="completed", last_error=None, locked_by=None, locked_until=None, updated_at=now)
+            )
+        db.commit()
+    finally:
+        db.close()
+
+
+def retry_or_fail_job(job: ClaimedJob, worker_id: str, error: str) -> bool:
+    """Schedule the next attempt, or mark the job failed. Returns True when it is final."""
+    if job.attempts >= job.max_attempts:
+        _finish_job(job.id, worker_id, status="failed", last_error=error)
+        return True
+
+    delay = min(JOB_RETRY_BASE_SECONDS * 2 ** (job.attempts - 1), JOB_RETRY_MAX_SECONDS)
+    _finish_job(
+        job.id, worker_id,
+        status="pending",
+        last_error=error,
+        next_run_at=datetime.utcnow() + timedelta(seconds=delay),
+    )
+    return False
+
+
+def release_job(job_id: int, worker_id: str, delay: float = 0, error: Optional[str] = None):
+    """Hand a job back to the queue without counting the attempt (graceful shutdown, rate limiting)"""
+    values = {"last_error": error} if error else {}
+    _finish_job(
+        job_id, worker_id,
+        status="pending",
+        attempts=Job.attempts - 1,
+        next_run_at=datetime.utcnow() + timedelta(seconds=delay),
+        **values,
+    )
+
+
+def recover_orphaned_work():
+    """Enqueue answers/messages left in progress by the pre-queue in-memory tasks, and prune old jobs"""
+    db = SessionLocal()
+    try:
+        def has_active_job(kind, target_column):
+            return exists().where(
+                Job.kind == kind,
+                Job.target_id == target_column,
+                Job.status.in_(ACTIVE_STATUSES),
+            )
+
+        answers = db.query(models.Answer.id, models.Answer.recording_sid, models.Answer.recording_duration).filter(
+            models.Answer.transcript_status == "processing",
+            models.Answer.recording_sid.isnot(None),
+            ~has_active_job("answer", models.Answer.id),
+        ).all()
+        for answer_id, recording_sid, duration in answers:
+            enqueue_transcription(db, "answer", answer_id, recording_sid, recording_duration=duration)
+
+        messages = db.query(models.Message.id, models.Message.recording_sid, models.Message.recording_duration).filter(
+            models.Message.transcript_text == "(文字起こし中...)",
+            models.Message.recording_sid.isnot(None),
+            ~has_active_job("message", models.Message.id),
+        ).all()
+        for message_id, recording_sid, duration in messages:
+            enqueue_transcription(db, "message", message_id, recording_sid, recording_duration=duration)
+
+        cutoff = datetime.utcnow() - timedelta(days=JOB_RETENTION_DAYS)
+        db.query(Job).filter(Job.status == "completed", Job.updated_at < cutoff).delete(synchronize_session=False)
+        prune_transcription_cache(db)
+        db.commit()
+
+        if answers or messages:
+            print(f"Recovered {len(answers)} answers and {len(messages)} messages without a transcription job")
+    finally:
+        db.close()
+
+
+def queue_stats(db: Session) -> dict:
+    """Backlog depth for sizing TRANSCRIPTION_WORKERS"""
+    now = datetime.utcnow()
+    counts = dict(db.query(Job.status, func.count(Job.id)).group_by(Job.status).all())
+    ready = db.query(func.count(Job.id)).filter(_claimable(now)).scalar()
+    oldest_ready = db.query(func.min(Job.next_run_at)).filter(_claimable(now)).scalar()
+    return {
+        "pending": counts.get("pending", 0),
+        "running": counts.get("running", 0),
+        "failed": counts.get("failed", 0),
+        "completed": counts.get("completed", 0),
+        "ready": ready,
+        "oldest_ready_age_seconds": int((now - oldest_ready).total_seconds()) if oldest_ready else 0,
+        "workers": len(_workers),
+        "in_flight": _in_flight,
+    }
+
+
+# --- Workers ---
+_loop = None
+_wakeup = None
+_workers = []
+_in_flight = 0
+_results = WriteBehindBuffer(
+    "transcription results", commit_finished_jobs, RESULT_BATCH_SIZE, RESULT_FLUSH_INTERVAL, RESULT_MAX_PENDING,
+)
+
+
+def notify_workers():
+    """Wake idle workers after enqueuing; safe to call from request threads"""
+    if _loop is None or _loop.is_closed():
+        return
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is _loop:
+        _wakeup.set()
+    else:
+        _loop.call_soon_threadsafe(_wakeup.set)
+
+
+async def _run_job(job: ClaimedJob) -> TranscriptResult:
+    if job.kind == "answer":
+        return await transcribe_answer(job.target_id, job.recording_sid, job.force, job.recording_duration)
+    elif job.kind == "message":
+        return await transcribe_message(job.target_id, job.recording_sid, job.force, job.recording_duration)
+    else:
+        raise ValueError(f"Unknown transcription job kind: {job.kind}")
+
+
+def _mark_target_failed(job: ClaimedJob, error: Exception):
+    if job.kind == "answer":
+        mark_answer_failed(
+            job.target_id, job.recording_sid, str(error), getattr(error, "audio_bytes", 0), getattr(error, "backend", None)
+        )
+    elif job.kind == "message":
+        mark_message_failed(
+            job.target_id, job.recording_sid, str(error), getattr(error, "audio_bytes", 0), getattr(error, "backend", None)
+        )
+
+
+async def _claim(worker_id: str) -> Optional[ClaimedJob]:
+    claim = asyncio.ensure_future(asyncio.to_thread(claim_job, worker_id))
+    try:
+        return await asyncio.shield(claim)
+    except asyncio.CancelledError:
+        # Shutting down: the claim still commits on its thread, so hand the job straight back
+        job = await claim
+        if job:
+            await asyncio.to_thread(release_job, job.id, worker_id)
+        raise
+
+
+async def _worker(worker_id: str):
+    global _in_flight
+    while True:
+        try:
+            _wakeup.clear()
+            job = await _claim(worker_id)
+            if job is None:
+                try:
+                    await asyncio.wait_for(_wakeup.wait(), timeout=JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _in_flight += 1
+            try:
+                result = await _run_job(job)
+            except asyncio.CancelledError:
+                await asyncio.to_thread(release_job, job.id, worker_id)
+                raise
+            except RateLimited as e:
+                # Throttled, not broken: try again once Whisper has room, without using up an attempt
+                await asyncio.to_thread(release_job, job.id, worker_id, e.retry_after, str(e))
+                metrics.transcription_jobs.inc(job.kind, "rate_limited")
+            except Exception as e:
+                final = await asyncio.to_thread(retry_or_fail_job, job, worker_id, str(e))
+                metrics.transcription_jobs.inc(job.kind, "failed" if final else "retried")
+                if final:
+                    await asyncio.to_thread(_mark_target_failed, job, e)
+                print(f"Transcription job {job.id} ({job.kind} {job.recording_sid}) attempt {job.attempts}/{job.max_attempts} failed: {e}")
+            else:
+                await _results.add(FinishedJob(job.id, worker_id, result))
+                metrics.transcription_jobs.inc(job.kind, "completed")
+            finally:
+                _in_flight -= 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Database hiccup while claiming/finishing; the lease protects the job, just back off
+            print(f"Transcription worker {worker_id} error: {e}")
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+
+
+async def start_workers():
+    global _loop, _wakeup
+    _loop = asyncio.get_running_loop()
+    _wakeup = asyncio.Event()
+    await asyncio.to_thread(recover_orphaned_work)
+    _results.start()
+
+    prefix = f"{socket.gethostname()}:{os.getpid()}"
+    for n in range(TRANSCRIPTION_WORKERS):
+        _workers.append(asyncio.create_task(_worker(f"{prefix}:{n}")))
+
+
+async def stop_workers():
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    await _results.stop()
@@ -1,18 +1,52 @@
-from fastapi import FastAPI
+import os
+from anyio import to_thread
+from fastapi import Depends, FastAPI
+from fastapi.responses import Response
 from fastapi.staticfiles import StaticFiles
-from .database import engine, Base
+from .database import engine, Base, SessionLocal
 from .routers import twilio, admin
+from . import backends, callstatus, jobs, metrics, search, stats
 
 # Create tables
 Base.metadata.create_all(bind=engine)
+search.install(engine)
 
 app = FastAPI(title="Twilio Scenario System")
+app.add_middleware(metrics.MetricsMiddleware)
+metrics.instrument_engine(engine)
 
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 
 app.include_router(twilio.router)
 app.include_router(admin.router)
 
+# Sync route handlers (all webhooks) run on this threadpool
+WEBHOOK_THREADPOOL_SIZE = int(os.getenv("WEBHOOK_THREADPOOL_SIZE", "40"))
+# /metrics takes the admin credentials (Prometheus: basic_auth) unless explicitly made public
+METRICS_PUBLIC = os.getenv("METRICS_PUBLIC", "false").lower() in ("1", "true", "yes")
+
+@app.on_event("startup")
+async def startup():
+    to_thread.current_default_thread_limiter().total_tokens = WEBHOOK_THREADPOOL_SIZE
+    await to_thread.run_sync(stats.backfill_daily_stats)
+    callstatus.buffer.start()
+    await jobs.start_workers()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await jobs.stop_workers()
+    await callstatus.buffer.stop()
+    backends.close_backends()
+
 @app.get("/")
 def read_root():
     return {"message": "System is running"}
+
+@app.get("/metrics", dependencies=[] if METRICS_PUBLIC else [Depends(admin.get_current_username)])
+def read_metrics():
+    db = SessionLocal()
+    try:
+        metrics.record_queue_stats(jobs.queue_stats(db))
+    finally:
+        db.close()
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
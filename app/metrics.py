@@ -0,0 +1,274 @@
+"""In-process metrics in the Prometheus text exposition format, served at /metrics.
+
+Recording a sample is a dict lookup, a bisect and a couple of additions under
+a per-metric lock, so instrumenting the webhook hot path costs microseconds.
+Each worker process keeps its own numbers; scrape every process (or dyno).
+
+Per-request DB query counts come from SQLAlchemy cursor events accumulating
+into a context variable that MetricsMiddleware sets for the request; the
+sync handlers see it because the threadpool copies the request's context.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SLOW_BUCKETS = (0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250)
+BYTES_BUCKETS = (16e3, 64e3, 256e3, 512e3, 1e6, 2e6, 5e6, 10e6, 25e6)
+
+_registry: List["_Metric"] = []
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[tuple, float] = {}
+
+    def set(self, value: float, *labels: str):
+        with self._lock:
+            self._values[labels] = value
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (+Inf last), sum, count]
+        self._values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels: str):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, *labels: str) -> "_Timer":
+        return _Timer(self, labels)
+
+    def _samples(self):
+        with self._lock:
+            items = [(k, (list(v[0]), v[1], v[2])) for k, v in self._values.items()]
+        lines = []
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Metrics ---
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "Request latency by route (until the response body is sent)",
+    ("method", "route", "status"),
+)
+db_queries_per_request = Histogram(
+    "http_request_db_queries", "SQL statements executed per request", ("route",), COUNT_BUCKETS,
+)
+db_time_per_request = Histogram(
+    "http_request_db_seconds", "Time spent in SQL statements per request", ("route",),
+)
+db_queries = Counter("db_queries_total", "SQL statements executed (requests and background work)")
+
+transcription_jobs = Counter(
+    "transcription_jobs_total", "Finished transcription job attempts by outcome", ("kind", "outcome"),
+)
+transcription_queue = Gauge("transcription_queue_jobs", "Transcription jobs by status", ("status",))
+transcription_ready = Gauge("transcription_queue_ready_jobs", "Jobs due to run now")
+transcription_oldest_ready = Gauge(
+    "transcription_queue_oldest_ready_age_seconds", "Age of the oldest job that is due to run",
+)
+transcription_in_flight = Gauge("transcription_in_flight_jobs", "Jobs being processed by this process")
+recording_download_retries = Counter(
+    "transcription_download_retries_total", "Twilio recording downloads retried because the recording was not ready",
+)
+whisper_processing_time = Histogram(
+    "whisper_processing_seconds", "Speech-to-text duration per recording", ("kind", "backend"), SLOW_BUCKETS,
+)
+whisper_audio_bytes = Histogram(
+    "whisper_audio_bytes", "Size of recordings transcribed", ("kind", "backend"), BYTES_BUCKETS,
+)
+twilio_fetch_duration = Histogram(
+    "twilio_recording_fetch_seconds", "Time until Twilio starts sending a recording", ("source", "result"),
+)
+transcription_cache_requests = Counter(
+    "transcription_cache_requests_total", "Transcript cache lookups before calling Whisper", ("result",),
+)
+write_behind_batch_size = Histogram(
+    "write_behind_batch_size", "Items committed per write-behind transaction", ("buffer",), COUNT_BUCKETS,
+)
+rate_limit = Gauge("rate_limit_requests_per_minute", "Current adaptive request rate", ("limiter",))
+rate_limited = Counter("rate_limited_total", "429 responses that made a limiter back off", ("limiter",))
+rate_limit_wait = Counter("rate_limit_wait_seconds_total", "Time callers spent waiting for a request slot", ("limiter",))
+recording_cache_requests = Counter(
+    "recording_cache_requests_total", "Recording cache lookups for proxy/download/ZIP routes", ("result",),
+)
+
+
+def record_queue_stats(stats: dict):
+    """Copy jobs.queue_stats() into the queue gauges (done at scrape time)"""
+    for status in ("pending", "running", "failed", "completed"):
+        transcription_queue.set(stats[status], status)
+    transcription_ready.set(stats["ready"])
+    transcription_oldest_ready.set(stats["oldest_ready_age_seconds"])
+    transcription_in_flight.set(stats["in_flight"])
+
+
+# --- Per-request DB accounting ---
+# [statement count, seconds] for the current request, or None outside a request
+_request_db: ContextVar[Optional[list]] = ContextVar("request_db", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["metrics_query_start"].pop()
+    db_queries.inc()
+    usage = _request_db.get()
+    if usage is not None:
+        usage[0] += 1
+        usage[1] += elapsed
+
+
+def _handle_error(exception_context):
+    # after_cursor_execute doesn't fire for a failed statement; drop its start time so the
+    # pooled connection's next statement doesn't pop the wrong one
+    conn = exception_context.connection
+    starts = conn.info.get("metrics_query_start") if conn is not None else None
+    if starts:
+        starts.pop()
+
+
+def instrument_engine(engine):
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware (no per-request task like BaseHTTPMiddleware) timing each route"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        usage = [0, 0.0]
+        token = _request_db.set(usage)
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_db.reset(token)
+            # Templated path (/twilio/record_callback, /admin/calls/{call_sid}) keeps cardinality bounded
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            http_request_duration.observe(time.perf_counter() - start, scope["method"], route, str(status[0]))
+            db_queries_per_request.observe(usage[0], route)
+            db_time_per_request.observe(usage[1], route)
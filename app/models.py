@@ -1,8 +1,15 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Boolean, Date, DateTime, Float, ForeignKey, Text, Index, UniqueConstraint
+from sqlalchemy.orm import relationship, validates
 from datetime import datetime
 from .database import Base
 
+def normalize_phone(number):
+    """Canonical E.164-ish form used for inbound number routing"""
+    normalized = number.strip().replace(' ', '').replace('-', '').replace('(', '').replace(')', '')
+    if not normalized.startswith('+'):
+        normalized = '+' + normalized
+    return normalized
+
 class Scenario(Base):
     __tablename__ = "scenarios"
 
@@ -12,6 +19,7 @@ class Scenario(Base):
     disclaimer_text = Column(String, nullable=True) # 録音告知など
     question_guidance_text = Column(String, nullable=True, default="このあと何点か質問をさせていただきます。回答が済みましたらシャープを押して次に進んでください") # 質問開始前のガイダンス
     is_active = Column(Boolean, default=True)
+    transcription_backend = Column(String, nullable=True) # openai / local / fake; NULL = global routing
     deleted_at = Column(DateTime, nullable=True) # Soft delete functionality
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -35,12 +43,18 @@ class PhoneNumber(Base):
     __tablename__ = "phone_numbers"
 
     to_number = Column(String, primary_key=True) # E.164 format
+    normalized_number = Column(String, unique=True, index=True) # normalize_phone(to_number), used for routing lookups
     scenario_id = Column(Integer, ForeignKey("scenarios.id"))
     label = Column(String, nullable=True) # UIでは「備考」として表示
     is_active = Column(Boolean, default=True)
 
     scenario = relationship("Scenario", back_populates="phone_numbers")
 
+    @validates("to_number")
+    def _sync_normalized_number(self, key, value):
+        self.normalized_number = normalize_phone(value) if value else None
+        return value
+
 class Question(Base):
     __tablename__ = "questions"
 
@@ -56,6 +70,13 @@ class Question(Base):
 
 class Call(Base):
     __tablename__ = "calls"
+    __table_args__ = (
+        # Keyset pagination for /admin/calls/ orders by (started_at, call_sid)
+        Index("ix_calls_started_at_call_sid", "started_at", "call_sid"),
+        # Status/duration filters and sorts on /admin/calls/ (filled in by /twilio/status_callback)
+        Index("ix_calls_status_started_at", "status", "started_at"),
+        Index("ix_calls_duration", "duration"),
+    )
 
     call_sid = Column(String, primary_key=True)
     from_number = Column(String, index=True)
@@ -63,7 +84,10 @@ class Call(Base):
     scenario_id = Column(Integer, ForeignKey("scenarios.id"), nullable=True)
     status = Column(String) # queued, ringing, in-progress, completed, busy, failed, no-answer
     started_at = Column(DateTime, default=datetime.utcnow)
+    ended_at = Column(DateTime, nullable=True)
+    duration = Column(Integer, nullable=True) # seconds, from Twilio's CallDuration
     created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True) # incremental export
     recording_sid = Column(String, nullable=True) # Full call recording SID
 
     answers = relationship("Answer", back_populates="call")
@@ -81,8 +105,10 @@ class Message(Base):
     call_sid = Column(String, ForeignKey("calls.call_sid"))
     recording_sid = Column(String, nullable=True)
     recording_url = Column(String, nullable=True)
+    recording_duration = Column(Integer, nullable=True) # seconds, from Twilio's RecordingDuration
     transcript_text = Column(Text, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
     call = relationship("Call", back_populates="messages")
 
@@ -96,6 +122,7 @@ class Answer(Base):
     
     recording_sid = Column(String, nullable=True)
     recording_url_twilio = Column(String, nullable=True)
+    recording_duration = Column(Integer, nullable=True) # seconds, from Twilio's RecordingDuration
     
     # Storage
     storage_url = Column(String, nullable=True) 
@@ -106,6 +133,7 @@ class Answer(Base):
     question_sort_at_call = Column(Integer, default=0) # Order snapshot
     
     created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
     call = relationship("Call", back_populates="answers")
     question = relationship("Question")
@@ -119,6 +147,7 @@ class TranscriptionLog(Base):
     
     id = Column(Integer, primary_key=True, index=True)
     answer_id = Column(Integer, ForeignKey("answers.id"), nullable=True)
+    message_id = Column(Integer, ForeignKey("messages.id"), nullable=True, index=True) # set instead of answer_id for messages
     service = Column(String, default="openai_whisper")
     status = Column(String) # success, failed
     
@@ -130,6 +159,91 @@ class TranscriptionLog(Base):
     
     request_payload = Column(Text, nullable=True)
     response_payload = Column(Text, nullable=True)
+    chunk_timings = Column(Text, nullable=True) # JSON per-chunk start/end/processing_time for split recordings
     processing_time = Column(Integer, default=0) # duration_sec renaming/alias
     
     created_at = Column(DateTime, default=datetime.utcnow)
+
+class TranscriptionJob(Base):
+    """Durable transcription work item, claimed by workers under a time-limited lease"""
+    __tablename__ = "transcription_jobs"
+    __table_args__ = (
+        Index("ix_transcription_jobs_status_next_run_at", "status", "next_run_at"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String) # answer, message
+    target_id = Column(Integer) # Answer.id or Message.id depending on kind
+    recording_sid = Column(String)
+    status = Column(String, default="pending") # pending, running, completed, failed
+    force = Column(Boolean, default=False) # bypass the transcription cache (explicit retranscribe)
+    batch_id = Column(Integer, ForeignKey("retranscription_batches.id"), nullable=True, index=True) # bulk retranscribe
+    recording_duration = Column(Integer, nullable=True) # seconds, from Twilio's RecordingDuration
+
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=5)
+    next_run_at = Column(DateTime, default=datetime.utcnow)
+    locked_by = Column(String, nullable=True) # worker id holding the lease
+    locked_until = Column(DateTime, nullable=True) # lease expiry; expired running jobs are reclaimed
+    last_error = Column(Text, nullable=True)
+
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class RetranscriptionBatch(Base):
+    """One POST /admin/retranscribe/bulk request; its jobs point back here for progress"""
+    __tablename__ = "retranscription_batches"
+
+    id = Column(Integer, primary_key=True, index=True)
+    filters = Column(Text) # JSON of the call filters + transcript_status used to select answers
+    total = Column(Integer, default=0)
+    rate_per_minute = Column(Integer)
+    force = Column(Boolean, default=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class TranscriptionCache(Base):
+    """Whisper output keyed by the exact inputs that produced it, so retranscribing unchanged audio is free"""
+    __tablename__ = "transcription_cache"
+    __table_args__ = (
+        UniqueConstraint("recording_sid", "audio_sha256", "model_name", "language", name="uq_transcription_cache_key"),
+        Index("ix_transcription_cache_last_used_at", "last_used_at"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    recording_sid = Column(String)
+    audio_sha256 = Column(String(64))
+    model_name = Column(String)
+    language = Column(String)
+
+    transcript_text = Column(Text)
+    audio_bytes = Column(Integer, default=0)
+    audio_duration = Column(Float, default=0)
+
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow) # LRU eviction order
+
+class DailyStat(Base):
+    """Per-day rollup for the dashboard, maintained at write time (see app/stats.py)"""
+    __tablename__ = "daily_stats"
+    __table_args__ = (
+        UniqueConstraint("day", "scenario_id", "to_number", name="uq_daily_stats_key"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    day = Column(Date, nullable=False)
+    scenario_id = Column(Integer, nullable=False, default=0) # 0 = no scenario
+    to_number = Column(String, nullable=False, default="")
+
+    calls = Column(Integer, default=0)
+    answers = Column(Integer, default=0)
+    messages = Column(Integer, default=0)
+    transcripts_completed = Column(Integer, default=0)
+    transcripts_failed = Column(Integer, default=0)
+
+class ExportWatermark(Base):
+    """How far a downstream consumer of /admin/export_zip?watermark=... has confirmed receiving changes"""
+    __tablename__ = "export_watermarks"
+
+    name = Column(String, primary_key=True)
+    exported_until = Column(DateTime) # rows with updated_at up to here have been exported and confirmed
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
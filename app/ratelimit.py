@@ -0,0 +1,105 @@
+"""Process-wide adaptive rate limiter for Whisper requests.
+
+A token bucket paces requests at the current rate. The rate adapts AIMD
+style: every success nudges it up by a fixed step (probing for headroom up to
+the configured ceiling), every 429 halves it and pauses all callers until the
+server's Retry-After has passed. Answer, message and retranscription jobs
+(and every chunk of a split recording) that go to the Whisper API all pass
+through the one OpenAIBackend in app/backends.py, so they share one limiter
+and back off together instead of each hammering the API on its own schedule.
+Local and fake backends are not paced.
+
+The limiter should start near the account's real limit (see WHISPER_RATE_*
+in app/backends.py): additive increase is meant to recover after a 429, and
+climbing from far below the limit takes many requests.
+
+All callers run on the transcription event loop, so the state needs no lock.
+"""
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Mapping, Optional
+
+from . import metrics
+
+
+class AdaptiveRateLimiter:
+    def __init__(self, name: str, rate_per_minute: float, min_rate_per_minute: float,
+                 max_rate_per_minute: float, burst: int, increase_per_success: float, default_cooldown: float):
+        self.name = name
+        self.min_rate = min_rate_per_minute
+        self.max_rate = max(max_rate_per_minute, rate_per_minute)
+        self.rate = rate_per_minute  # requests per minute right now
+        self.burst = max(1, burst)
+        self.increase_per_success = increase_per_success
+        self.default_cooldown = default_cooldown
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        metrics.rate_limit.set(self.rate, self.name)
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate / 60)
+        self._updated = now
+
+    async def acquire(self):
+        """Wait for a request slot"""
+        waited = 0.0
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                wait = self._paused_until - now
+            else:
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    if waited:
+                        metrics.rate_limit_wait.inc(self.name, amount=waited)
+                    return
+                wait = (1 - self._tokens) * 60 / self.rate
+            # Jitter so callers woken together don't all race for the same token
+            wait *= 1 + random.random() * 0.1
+            waited += wait
+            await asyncio.sleep(wait)
+
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + self.increase_per_success)
+        metrics.rate_limit.set(self.rate, self.name)
+
+    def on_rate_limited(self, retry_after: Optional[float]) -> float:
+        """Halve the rate and pause everyone; returns the pause in seconds"""
+        cooldown = retry_after if retry_after is not None else self.default_cooldown
+        now = time.monotonic()
+        # Requests already in flight when the first 429 arrived report the same overload: halve once
+        if now >= self._paused_until:
+            self.rate = max(self.min_rate, self.rate / 2)
+        self._tokens = 0.0
+        self._updated = now
+        self._paused_until = max(self._paused_until, now + cooldown)
+        metrics.rate_limit.set(self.rate, self.name)
+        metrics.rate_limited.inc(self.name)
+        return cooldown
+
+
+def retry_after_seconds(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    """Seconds to wait from retry-after-ms / Retry-After (delta-seconds or HTTP date), if present"""
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return max(0.0, float(value) / 1000)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,181 @@
+"""Twilio recording fetches backed by a size-bounded on-disk LRU cache.
+
+Recording media never changes once Twilio has it, so files are cached by SID
+and served locally afterwards (FileResponse takes care of Range/206 for
+seeking). A cache miss without a Range header is passed through to the client
+chunk by chunk while being written to the cache.
+"""
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import BinaryIO, Iterable, Iterator, Optional, Tuple
+
+import requests
+
+from . import metrics
+
+TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
+TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
+# Overridable so load tests can point recording fetches at a local stand-in
+TWILIO_API_BASE_URL = os.getenv("TWILIO_API_BASE_URL", "https://api.twilio.com").rstrip("/")
+
+RECORDING_CACHE_DIR = os.getenv("RECORDING_CACHE_DIR", os.path.join(tempfile.gettempdir(), "recording_cache"))
+RECORDING_CACHE_MAX_BYTES = int(os.getenv("RECORDING_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+RECORDING_FETCH_TIMEOUT = float(os.getenv("RECORDING_FETCH_TIMEOUT", "30"))
+RECORDING_FETCH_CONCURRENCY = int(os.getenv("RECORDING_FETCH_CONCURRENCY", "6"))
+# A .part file untouched for this long belongs to a crashed or abandoned download
+# (live downloads write at least every RECORDING_FETCH_TIMEOUT unless the client stalls)
+RECORDING_PART_STALE_SECONDS = float(os.getenv("RECORDING_PART_STALE_SECONDS", str(max(600, RECORDING_FETCH_TIMEOUT * 4))))
+CHUNK_SIZE = 64 * 1024
+
+_SID_RE = re.compile(r"^[A-Za-z0-9]+$")
+_evict_lock = threading.Lock()
+
+
+class RecordingNotFound(Exception):
+    pass
+
+
+def recording_url(recording_sid: str, fmt: str = "mp3") -> str:
+    return f"{TWILIO_API_BASE_URL}/2010-04-01/Accounts/{TWILIO_ACCOUNT_SID}/Recordings/{recording_sid}.{fmt}"
+
+
+def _cache_path(recording_sid: str) -> str:
+    # SIDs end up in a filesystem path, so only accept plain alphanumerics
+    if not _SID_RE.match(recording_sid):
+        raise RecordingNotFound(recording_sid)
+    return os.path.join(RECORDING_CACHE_DIR, f"{recording_sid}.mp3")
+
+
+def get_cached_recording(recording_sid: str) -> Optional[str]:
+    """Path of the cached MP3, refreshing its LRU position, or None on a miss"""
+    path = _cache_path(recording_sid)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        metrics.recording_cache_requests.inc("miss")
+        return None
+    metrics.recording_cache_requests.inc("hit")
+    return path
+
+
+def open_twilio_stream(recording_sid: str) -> requests.Response:
+    _cache_path(recording_sid)  # validate before going to Twilio
+    start = time.perf_counter()
+    response = requests.get(
+        recording_url(recording_sid),
+        auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN),
+        stream=True,
+        timeout=RECORDING_FETCH_TIMEOUT,
+    )
+    metrics.twilio_fetch_duration.observe(time.perf_counter() - start, "admin", str(response.status_code))
+    if response.status_code != 200:
+        response.close()
+        raise RecordingNotFound(recording_sid)
+    return response
+
+
+def stream_into_cache(recording_sid: str, response: requests.Response) -> Iterator[bytes]:
+    """Yield the Twilio body chunk by chunk, committing it to the cache once complete.
+
+    If the client goes away mid-stream the partial file is discarded.
+    """
+    os.makedirs(RECORDING_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=RECORDING_CACHE_DIR, suffix=".part")
+    completed = False
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                tmp.write(chunk)
+                yield chunk
+        try:
+            os.replace(tmp_path, _cache_path(recording_sid))
+        except FileNotFoundError:
+            return  # evicted as stale while the client stalled; it still got every byte
+        completed = True
+        evict()
+    finally:
+        response.close()
+        if not completed and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def fetch_recording(recording_sid: str) -> str:
+    """Return a local path for the recording, downloading it into the cache on a miss"""
+    path = get_cached_recording(recording_sid)
+    if path:
+        return path
+    for _ in stream_into_cache(recording_sid, open_twilio_stream(recording_sid)):
+        pass
+    return _cache_path(recording_sid)
+
+
+def evict():
+    """Drop stale partial downloads, then least recently used recordings until the cache fits
+    RECORDING_CACHE_MAX_BYTES (downloads in progress count towards it)"""
+    with _evict_lock:
+        entries = []
+        total = 0
+        stale_before = time.time() - RECORDING_PART_STALE_SECONDS
+        with os.scandir(RECORDING_CACHE_DIR) as it:
+            for entry in it:
+                is_part = entry.name.endswith(".part")
+                if not (is_part or entry.name.endswith(".mp3")):
+                    continue
+                try:
+                    stat = entry.stat()
+                    if is_part and stat.st_mtime < stale_before:
+                        os.remove(entry.path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                total += stat.st_size
+                if not is_part:
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= RECORDING_CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def _open_recording(recording_sid: str) -> BinaryIO:
+    # Open right away: an open handle stays readable even if eviction unlinks the file
+    return open(fetch_recording(recording_sid), "rb")
+
+
+def fetch_many(items: Iterable[Tuple[str, str]], concurrency: int = RECORDING_FETCH_CONCURRENCY) -> Iterator[Tuple[str, BinaryIO]]:
+    """Fetch (name, recording_sid) pairs concurrently, yielding (name, open file) as each one lands.
+
+    Recordings Twilio doesn't have (or that fail to download) are skipped.
+    """
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    try:
+        futures = {executor.submit(_open_recording, sid): (name, sid) for name, sid in items}
+        for future in as_completed(futures):
+            name, sid = futures[future]
+            try:
+                yield name, future.result()
+            except (RecordingNotFound, requests.RequestException) as e:
+                print(f"Skipping recording {sid}: {e!r}")
+    finally:
+        # Client disconnected or we're done: don't start fetches nobody will read
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def file_chunks(f: BinaryIO) -> Iterator[bytes]:
+    """Read an open file in chunks, closing it at the end"""
+    with f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
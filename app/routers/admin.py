@@ -1,16 +1,22 @@
 from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
-from fastapi.responses import StreamingResponse, Response
+from fastapi.responses import FileResponse, StreamingResponse, Response
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import exists, func, select, tuple_, union
+from sqlalchemy.orm import Session, joinedload, selectinload
 from typing import List, Optional
-import csv
-import io
+import base64
+import json
 import os
+import re
 import requests
 import secrets
-from datetime import datetime
-from ..database import get_db
-from .. import models, schemas
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from ..database import get_db, SessionLocal
+from ..cache import invalidate_phone_number, invalidate_all_phone_numbers, invalidate_scenario
+from ..jobs import ACTIVE_STATUSES, enqueue_transcription, notify_workers, queue_stats
+from .. import models, schemas, recordings, search, stats, parquet_export
+from ..zipstream import stream_encrypted_zip, csv_chunks
 
 security = HTTPBasic()
 
@@ -35,6 +41,9 @@ router = APIRouter(
 TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
 TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
 
+# Default pace for bulk retranscription, in jobs started per minute
+RETRANSCRIBE_BULK_RATE = int(os.getenv("RETRANSCRIBE_BULK_RATE", "60"))
+
 # --- Scenarios ---
 @router.post("/scenarios/", response_model=schemas.Scenario)
 def create_scenario(scenario: schemas.ScenarioCreate, db: Session = Depends(get_db)):
@@ -50,11 +59,13 @@ def update_scenario(scenario_id: int, scenario: schemas.ScenarioCreate, db: Sess
     if not db_scenario:
         raise HTTPException(status_code=404, detail="Scenario not found")
     
-    for key, value in scenario.dict().items():
+    for key, value in scenario.dict(exclude_unset=True).items():
         setattr(db_scenario, key, value)
     
     db.commit()
     db.refresh(db_scenario)
+    invalidate_scenario(scenario_id)
+    invalidate_all_phone_numbers()
     return db_scenario
 
 @router.delete("/scenarios/{scenario_id}")
@@ -69,6 +80,8 @@ def delete_scenario(scenario_id: int, db: Session = Depends(get_db)):
     # db.query(models.Question).filter(models.Question.scenario_id == scenario_id).delete()
     
     db.commit()
+    invalidate_scenario(scenario_id)
+    invalidate_all_phone_numbers()
     return {"message": "Scenario deleted (soft)"}
 
 @router.get("/scenarios/", response_model=List[schemas.Scenario])
@@ -92,6 +105,7 @@ def create_question(question: schemas.QuestionCreate, db: Session = Depends(get_
     db.add(db_question)
     db.commit()
     db.refresh(db_question)
+    invalidate_scenario(db_question.scenario_id)
     return db_question
 
 @router.put("/questions/{question_id}", response_model=schemas.Question)
@@ -106,6 +120,7 @@ def update_question(question_id: int, question_update: schemas.QuestionBase, db:
     
     db.commit()
     db.refresh(db_question)
+    invalidate_scenario(db_question.scenario_id)
     return db_question
 
 @router.delete("/questions/{question_id}")
@@ -114,8 +129,10 @@ def delete_question(question_id: int, db: Session = Depends(get_db)):
     if not db_question:
         raise HTTPException(status_code=404, detail="Question not found")
     
+    scenario_id = db_question.scenario_id
     db.delete(db_question)
     db.commit()
+    invalidate_scenario(scenario_id)
     return {"message": "Question deleted"}
 
 @router.get("/scenarios/{scenario_id}/questions", response_model=List[schemas.Question])
@@ -131,6 +148,7 @@ def create_ending_guidance(guidance: schemas.EndingGuidanceCreate, db: Session =
     db.add(db_guidance)
     db.commit()
     db.refresh(db_guidance)
+    invalidate_scenario(db_guidance.scenario_id)
     return db_guidance
 
 @router.put("/ending_guidances/{guidance_id}", response_model=schemas.EndingGuidance)
@@ -144,6 +162,7 @@ def update_ending_guidance(guidance_id: int, guidance_update: schemas.EndingGuid
     
     db.commit()
     db.refresh(db_guidance)
+    invalidate_scenario(db_guidance.scenario_id)
     return db_guidance
 
 @router.delete("/ending_guidances/{guidance_id}")
@@ -152,8 +171,10 @@ def delete_ending_guidance(guidance_id: int, db: Session = Depends(get_db)):
     if not db_guidance:
         raise HTTPException(status_code=404, detail="Guidance not found")
     
+    scenario_id = db_guidance.scenario_id
     db.delete(db_guidance)
     db.commit()
+    invalidate_scenario(scenario_id)
     return {"message": "Guidance deleted"}
 
 @router.get("/scenarios/{scenario_id}/ending_guidances", response_model=List[schemas.EndingGuidance])
@@ -170,7 +191,10 @@ def create_or_update_phone_number(phone: schemas.PhoneNumberCreate, db: Session
     if not to_number.startswith('+'):
         to_number = '+' + to_number
     
-    db_phone = db.query(models.PhoneNumber).filter(models.PhoneNumber.to_number == to_number).first()
+    # Match on the normalized form so "+81 90-..." and "+8190..." are the same entry
+    db_phone = db.query(models.PhoneNumber).filter(
+        models.PhoneNumber.normalized_number == models.normalize_phone(to_number)
+    ).first()
     if db_phone:
         db_phone.scenario_id = phone.scenario_id
         db_phone.label = phone.label
@@ -185,15 +209,19 @@ def create_or_update_phone_number(phone: schemas.PhoneNumberCreate, db: Session
         db.add(db_phone)
     db.commit()
     db.refresh(db_phone)
+    invalidate_phone_number(db_phone.to_number)
     return db_phone
 
 @router.delete("/phone_numbers/{to_number}")
 def delete_phone_number(to_number: str, db: Session = Depends(get_db)):
-    db_phone = db.query(models.PhoneNumber).filter(models.PhoneNumber.to_number == to_number).first()
+    db_phone = db.query(models.PhoneNumber).filter(
+        models.PhoneNumber.normalized_number == models.normalize_phone(to_number)
+    ).first()
     if not db_phone:
         raise HTTPException(status_code=404, detail="Phone number not found")
     db.delete(db_phone)
     db.commit()
+    invalidate_phone_number(to_number)
     return {"message": "Phone number deleted"}
 
 @router.get("/phone_numbers/", response_model=List[schemas.PhoneNumber])
@@ -201,139 +229,170 @@ def read_phone_numbers(db: Session = Depends(get_db)):
     return db.query(models.PhoneNumber).all()
 
 # --- Recording Download ---
+def _serve_recording(request: Request, recording_sid: str, headers: dict):
+    """Serve a recording from the local cache (Range-aware), or pass Twilio's body through while caching it"""
+    try:
+        path = recordings.get_cached_recording(recording_sid)
+        if not path and request.headers.get("range"):
+            # Seeking needs the whole file locally; fetch it once, then answer the range from disk
+            path = recordings.fetch_recording(recording_sid)
+        if path:
+            return FileResponse(path, media_type="audio/mpeg", headers=headers)
+        response = recordings.open_twilio_stream(recording_sid)
+    except recordings.RecordingNotFound:
+        raise HTTPException(status_code=404, detail="Recording not found")
+    except requests.RequestException:
+        raise HTTPException(status_code=502, detail="Failed to fetch recording from Twilio")
+    
+    headers = dict(headers, **{"Accept-Ranges": "bytes"})
+    if response.headers.get("Content-Length"):
+        headers["Content-Length"] = response.headers["Content-Length"]
+    return StreamingResponse(
+        recordings.stream_into_cache(recording_sid, response),
+        media_type="audio/mpeg",
+        headers=headers
+    )
+
 @router.get("/download_recording/{recording_sid}")
-def download_recording(recording_sid: str):
+def download_recording(recording_sid: str, request: Request):
     """Download a single recording from Twilio"""
     if not TWILIO_ACCOUNT_SID or not TWILIO_AUTH_TOKEN:
         raise HTTPException(status_code=500, detail="Twilio credentials not configured")
     
-    url = f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_ACCOUNT_SID}/Recordings/{recording_sid}.mp3"
-    
-    response = requests.get(url, auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN), stream=True)
-    
-    if response.status_code != 200:
-        raise HTTPException(status_code=404, detail="Recording not found")
-    
-    return StreamingResponse(
-        io.BytesIO(response.content),
-        media_type="audio/mpeg",
-        headers={"Content-Disposition": f"attachment; filename={recording_sid}.mp3"}
+    return _serve_recording(request, recording_sid, {
+        "Content-Disposition": f"attachment; filename={recording_sid}.mp3"
+    })
+
+def _sanitize_filename(s):
+    return re.sub(r'[\\/*?:"<>|]', "", s)
+
+def _call_recording_files(call_sid: str, call, answers):
+    """(zip filename, recording_sid) pairs for one call's full recording and answers"""
+    date_part = call.started_at.strftime('%Y%m%d') if call else "00000000"
+    sc_name = _sanitize_filename(call.scenario.name) if call and call.scenario else "NoScenario"
+    to_num = call.to_number.replace('+','') if call else "000"
+    from_num = call.from_number.replace('+','') if call else "000"
+    short_sid = call_sid[-6:]
+    prefix = f"{date_part}_{sc_name}_{to_num}_{from_num}_{short_sid}"
+    
+    files = []
+    # 1. Full Recording
+    if call and call.recording_sid:
+        files.append((f"{prefix}_FULL.mp3", call.recording_sid))
+    # 2. Answers
+    for idx, answer in enumerate(answers, 1):
+        if answer.recording_sid:
+            files.append((f"{prefix}_Q{idx}.mp3", answer.recording_sid))
+    return files
+
+def _stream_recordings_zip(files):
+    """Fetch recordings concurrently and add each to the archive as soon as it arrives"""
+    return stream_encrypted_zip(
+        (filename, recordings.file_chunks(f)) for filename, f in recordings.fetch_many(files)
     )
 
 @router.get("/download_call_recordings/{call_sid}")
 def download_call_recordings(call_sid: str, db: Session = Depends(get_db)):
     """Download all recordings for a call as a ZIP file"""
-    import pyzipper
-    import re
-    
     if not TWILIO_ACCOUNT_SID or not TWILIO_AUTH_TOKEN:
         raise HTTPException(status_code=500, detail="Twilio credentials not configured")
     
     # Get all answers for this call
-    answers = db.query(models.Answer).filter(models.Answer.call_sid == call_sid).all()
+    answers = db.query(models.Answer).filter(models.Answer.call_sid == call_sid).order_by(models.Answer.id).all()
     # Also fetch Call for naming
     call = db.query(models.Call).filter(models.Call.call_sid == call_sid).first()
     
     if not answers and not (call and call.recording_sid):
         raise HTTPException(status_code=404, detail="No recordings found for this call")
     
-    # Naming Helpers
-    def sanitize(s): return re.sub(r'[\\/*?:"<>|]', "", s)
-    
-    date_part = call.started_at.strftime('%Y%m%d') if call else "00000000"
-    sc_name = sanitize(call.scenario.name) if call and call.scenario else "NoScenario"
-    to_num = call.to_number.replace('+','') if call else "000"
-    from_num = call.from_number.replace('+','') if call else "000"
-    short_sid = call_sid[-6:]
-    
-    # Create ZIP in memory
-    zip_buffer = io.BytesIO()
-    with pyzipper.AESZipFile(zip_buffer, 'w', compression=pyzipper.ZIP_DEFLATED, encryption=pyzipper.WZ_AES) as zip_file:
-        zip_file.setpassword(b"attendme")
-        zip_file.setencryption(pyzipper.WZ_AES, nbits=256)
-        
-        # 1. Full Recording
-        if call and call.recording_sid:
-            url = f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_ACCOUNT_SID}/Recordings/{call.recording_sid}.mp3"
-            response = requests.get(url, auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN))
-            if response.status_code == 200:
-                filename = f"{date_part}_{sc_name}_{to_num}_{from_num}_{short_sid}_FULL.mp3"
-                zip_file.writestr(filename, response.content)
-
-        # 2. Answers
-        for idx, answer in enumerate(answers, 1):
-            if answer.recording_sid:
-                url = f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_ACCOUNT_SID}/Recordings/{answer.recording_sid}.mp3"
-                response = requests.get(url, auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN))
-                
-                if response.status_code == 200:
-                    filename = f"{date_part}_{sc_name}_{to_num}_{from_num}_{short_sid}_Q{idx}.mp3"
-                    zip_file.writestr(filename, response.content)
-    
-    zip_buffer.seek(0)
-    
     return StreamingResponse(
-        zip_buffer,
+        _stream_recordings_zip(_call_recording_files(call_sid, call, answers)),
         media_type="application/zip",
         headers={"Content-Disposition": f"attachment; filename=call_{call_sid}_recordings.zip"}
     )
 
-@router.get("/audio_proxy/{recording_sid}")
-def proxy_audio_playback(recording_sid: str):
-    """Proxy stream audio from Twilio for playback in admin UI"""
+@router.get("/download_recordings")
+def download_filtered_recordings(
+    limit: int = 100,
+    to_number: Optional[str] = None,
+    from_number: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    scenario_status: str = "active",
+    scenario_id: Optional[int] = None,
+    db: Session = Depends(get_db)
+):
+    """Download the recordings of every call matching the /calls/ filters as one ZIP file"""
     if not TWILIO_ACCOUNT_SID or not TWILIO_AUTH_TOKEN:
         raise HTTPException(status_code=500, detail="Twilio credentials not configured")
-
-    url = f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_ACCOUNT_SID}/Recordings/{recording_sid}.mp3"
     
-    # Proxy without loading full content if possible, or simple get content
-    # For <audio> tag seeking, range headers are complex.
-    # Simple proxy: fetch entire content and stream back.
+    query = db.query(models.Call).options(joinedload(models.Call.scenario))
+    query = _filter_calls(query, to_number, from_number, start_date, end_date, scenario_status, scenario_id)
+    calls = query.order_by(models.Call.started_at.desc()).limit(limit).all()
+    
+    answers = defaultdict(list)
+    if calls:
+        for answer in db.query(models.Answer).filter(
+            models.Answer.call_sid.in_([c.call_sid for c in calls])
+        ).order_by(models.Answer.id):
+            answers[answer.call_sid].append(answer)
     
-    response = requests.get(url, auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN), stream=True)
+    files = []
+    for call in calls:
+        files.extend(_call_recording_files(call.call_sid, call, answers[call.call_sid]))
+    if not files:
+        raise HTTPException(status_code=404, detail="No recordings found for these calls")
     
-    if response.status_code != 200:
-         raise HTTPException(status_code=404, detail="Recording not found")
-         
+    filename = f"recordings_{datetime.now().strftime('%Y%m%d%H%M')}.zip"
     return StreamingResponse(
-        io.BytesIO(response.content), # Not truly streaming in this simple proxy implementation to avoid range complexity
-        media_type="audio/mpeg",
-        headers={
-            "Content-Disposition": "inline",
-            "Cache-Control": "public, max-age=3600"
-        }
+        _stream_recordings_zip(files),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
 
+@router.get("/audio_proxy/{recording_sid}")
+def proxy_audio_playback(recording_sid: str, request: Request):
+    """Proxy stream audio from Twilio for playback in admin UI (seekable, served locally once cached)"""
+    if not TWILIO_ACCOUNT_SID or not TWILIO_AUTH_TOKEN:
+        raise HTTPException(status_code=500, detail="Twilio credentials not configured")
+
+    return _serve_recording(request, recording_sid, {
+        "Content-Disposition": "inline",
+        "Cache-Control": "public, max-age=3600"
+    })
+
 # --- Logs & Stats ---
-@router.get("/calls/", response_model=List[schemas.CallLog])
-def read_calls(
-    skip: int = 0, 
-    limit: int = 100, 
-    to_number: Optional[str] = None, 
+EXPORT_BATCH_SIZE = 500
+# Incremental exports stop this far behind now; commits land within seconds of their updated_at
+EXPORT_WATERMARK_LAG_SECONDS = int(os.getenv("EXPORT_WATERMARK_LAG_SECONDS", "120"))
+
+def _filter_calls(
+    query,
+    to_number: Optional[str] = None,
     from_number: Optional[str] = None,
     start_date: Optional[str] = None,  # YYYY-MM-DD format
     end_date: Optional[str] = None,    # YYYY-MM-DD format
     scenario_status: str = "active",   # active or deleted
     scenario_id: Optional[int] = None,
-    db: Session = Depends(get_db)
+    call_status: Optional[str] = None,  # comma-separated, e.g. "busy,no-answer"
+    changed_since: Optional[datetime] = None,  # call, or one of its answers/messages, updated after this
+    changed_until: Optional[datetime] = None,  # ... and at or before this
 ):
-    from datetime import datetime
-    
-    query = db.query(models.Call).options(
-        joinedload(models.Call.answers).joinedload(models.Answer.question),
-        joinedload(models.Call.scenario),
-        joinedload(models.Call.messages)
-    )
+    """Apply the dashboard's call filters to a query over models.Call"""
+    from datetime import timedelta
     
     # Scenario Status Filter
     if scenario_status == "active":
-        query = query.join(models.Scenario).filter(models.Scenario.deleted_at.is_(None))
+        query = query.join(models.Scenario, models.Call.scenario_id == models.Scenario.id).filter(models.Scenario.deleted_at.is_(None))
     elif scenario_status == "deleted":
-        query = query.join(models.Scenario).filter(models.Scenario.deleted_at.isnot(None))
+        query = query.join(models.Scenario, models.Call.scenario_id == models.Scenario.id).filter(models.Scenario.deleted_at.isnot(None))
     
     if scenario_id:
         query = query.filter(models.Call.scenario_id == scenario_id)
         
+    if call_status:
+        query = query.filter(models.Call.status.in_([s.strip() for s in call_status.split(",") if s.strip()]))
+        
     if to_number:
         query = query.filter(models.Call.to_number == to_number)
     if from_number:
@@ -343,120 +402,308 @@ def read_calls(
         start_dt = datetime.strptime(start_date, "%Y-%m-%d")
         query = query.filter(models.Call.started_at >= start_dt)
     if end_date:
-        from datetime import timedelta
         end_dt = datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=1)
         query = query.filter(models.Call.started_at < end_dt)
+
+    if changed_since or changed_until:
+        # Each arm is a range scan on that table's updated_at index
+        changed = []
+        for model in (models.Call, models.Answer, models.Message):
+            arm = select(model.call_sid)
+            if changed_since:
+                arm = arm.where(model.updated_at > changed_since)
+            if changed_until:
+                arm = arm.where(model.updated_at <= changed_until)
+            changed.append(arm)
+        query = query.filter(models.Call.call_sid.in_(union(*changed)))
+    return query
+
+def _encode_cursor(started_at: datetime, call_sid: str) -> str:
+    payload = json.dumps([started_at.isoformat(), call_sid]).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+def _decode_cursor(cursor: str):
+    try:
+        payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        started_at, call_sid = json.loads(payload)
+        return datetime.fromisoformat(started_at), call_sid
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@router.get("/calls/", response_model=List[schemas.CallLog])
+def read_calls(
+    response: Response,
+    skip: int = 0, 
+    limit: int = 100, 
+    to_number: Optional[str] = None, 
+    from_number: Optional[str] = None,
+    start_date: Optional[str] = None,  # YYYY-MM-DD format
+    end_date: Optional[str] = None,    # YYYY-MM-DD format
+    scenario_status: str = "active",   # active or deleted
+    scenario_id: Optional[int] = None,
+    call_status: Optional[str] = None, # comma-separated, e.g. "completed" or "busy,no-answer"
+    sort: str = "started_at",          # started_at or duration (longest first; skip/limit paging)
+    cursor: Optional[str] = None,      # X-Next-Cursor from the previous page
+    db: Session = Depends(get_db)
+):
+    """Calls newest first. Pass the X-Next-Cursor response header back as `cursor` for the next page."""
+    if sort not in ("started_at", "duration"):
+        raise HTTPException(status_code=400, detail="sort must be started_at or duration")
+    if cursor and sort != "started_at":
+        # The cursor encodes a (started_at, call_sid) position; it means nothing in duration order
+        raise HTTPException(status_code=400, detail="cursor paging is only available with sort=started_at; use skip")
+    # Collections load through separate IN queries so LIMIT applies to calls, not to a joined row set
+    query = db.query(models.Call).options(
+        selectinload(models.Call.answers).joinedload(models.Answer.question),
+        joinedload(models.Call.scenario),
+        selectinload(models.Call.messages)
+    )
+    query = _filter_calls(query, to_number, from_number, start_date, end_date, scenario_status, scenario_id, call_status)
+    if sort == "duration":
+        # Calls without a final status callback yet (NULL duration) go last; offset paging, no X-Next-Cursor
+        query = query.order_by(models.Call.duration.desc().nulls_last(), models.Call.call_sid.desc())
+        return query.offset(skip).limit(limit).all()
+    query = query.order_by(models.Call.started_at.desc(), models.Call.call_sid.desc())
+    
+    if cursor:
+        # Keyset: seek past the last row of the previous page via ix_calls_started_at_call_sid
+        started_at, call_sid = _decode_cursor(cursor)
+        query = query.filter(tuple_(models.Call.started_at, models.Call.call_sid) < tuple_(started_at, call_sid))
+    else:
+        query = query.offset(skip)
         
-    calls = query.order_by(models.Call.started_at.desc()).offset(skip).limit(limit).all()
+    calls = query.limit(limit).all()
+    if calls and len(calls) == limit:
+        response.headers["X-Next-Cursor"] = _encode_cursor(calls[-1].started_at, calls[-1].call_sid)
     return calls 
 
+@router.get("/search")
+def search_transcripts(
+    q: str = Query(..., min_length=1),
+    skip: int = 0,
+    limit: int = Query(50, ge=1, le=200),
+    to_number: Optional[str] = None,
+    from_number: Optional[str] = None,
+    start_date: Optional[str] = None,  # YYYY-MM-DD format
+    end_date: Optional[str] = None,    # YYYY-MM-DD format
+    scenario_status: str = "active",   # active or deleted
+    scenario_id: Optional[int] = None,
+    db: Session = Depends(get_db)
+):
+    """Answers and messages whose transcript contains every space-separated term of `q`, best match first"""
+    call_sids = None
+    if any([to_number, from_number, start_date, end_date, scenario_id, scenario_status in ("active", "deleted")]):
+        call_sids = select(_filter_calls(
+            db.query(models.Call.call_sid), to_number, from_number, start_date, end_date, scenario_status, scenario_id
+        ).subquery().c.call_sid)
+    # One extra row tells us whether there is a next page
+    hits = search.search_transcripts(db, q, call_sids, limit + 1, skip)
+
+    calls = {c.call_sid: c for c in db.query(models.Call).options(joinedload(models.Call.scenario)).filter(
+        models.Call.call_sid.in_({h.call_sid for h in hits})
+    )} if hits else {}
+    answer_ids = [h.id for h in hits if h.kind == "answer"]
+    questions = dict(db.query(models.Answer.id, models.Question.text).join(
+        models.Question, models.Answer.question_id == models.Question.id
+    ).filter(models.Answer.id.in_(answer_ids))) if answer_ids else {}
+
+    terms = q.split()
+    results = []
+    for hit in hits[:limit]:
+        call = calls.get(hit.call_sid)
+        results.append({
+            "kind": hit.kind,
+            "id": hit.id,
+            "call_sid": hit.call_sid,
+            "started_at": call.started_at if call else None,
+            "from_number": call.from_number if call else None,
+            "to_number": call.to_number if call else None,
+            "scenario_name": call.scenario_name if call else None,
+            "question_text": questions.get(hit.id) if hit.kind == "answer" else None,
+            "snippet": search.snippet(hit.text, terms),
+        })
+    return {"results": results, "next_skip": skip + limit if len(hits) > limit else None}
+
+def _format_domestic(phone):
+    if not phone: return ""
+    if phone.startswith("+81"): return "0" + phone[3:]
+    return phone
+
+def _iter_call_batches(db: Session, filters: dict):
+    """Matching calls as lightweight row tuples, newest first, in EXPORT_BATCH_SIZE lists"""
+    query = db.query(
+        models.Call.call_sid, models.Call.started_at, models.Call.to_number,
+        models.Call.from_number, models.Call.status, models.Call.scenario_id
+    )
+    query = _filter_calls(query, **filters).order_by(models.Call.started_at.desc())
+    
+    batch = []
+    for row in query.yield_per(EXPORT_BATCH_SIZE):
+        batch.append(row)
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _export_log_rows(db: Session, filters: dict, scenario_names: dict):
+    yield ["CallSid", "Date", "To", "From", "ScenarioName", "Status", "Question", "AnswerType", "Transcript", "RecordingURL"]
+    
+    for batch in _iter_call_batches(db, filters):
+        # One IN query per batch instead of a joinedload fan-out over every call
+        answers = defaultdict(list)
+        for ans in db.query(
+            models.Answer.call_sid, models.Question.text, models.Answer.answer_type,
+            models.Answer.transcript_text, models.Answer.recording_url_twilio
+        ).outerjoin(models.Question, models.Answer.question_id == models.Question.id).filter(
+            models.Answer.call_sid.in_([c.call_sid for c in batch])
+        ).order_by(models.Answer.id):
+            answers[ans.call_sid].append(ans)
+        
+        for call in batch:
+            scenario_name = scenario_names.get(call.scenario_id, "Unknown")
+            date_str = call.started_at.strftime("%Y-%m-%d %H:%M:%S")
+            to_dom = _format_domestic(call.to_number)
+            from_dom = _format_domestic(call.from_number)
+            
+            if not answers[call.call_sid]:
+                yield [
+                    call.call_sid, date_str, to_dom, from_dom, 
+                    scenario_name, call.status, "-", "-", "-", "-"
+                ]
+            else:
+                for ans in answers[call.call_sid]:
+                    yield [
+                        call.call_sid, date_str, to_dom, from_dom,
+                        scenario_name, call.status, ans.text or "Unknown", ans.answer_type, 
+                        ans.transcript_text or "", 
+                        ans.recording_url_twilio or ""
+                    ]
+
+def _export_message_rows(db: Session, filters: dict, scenario_names: dict):
+    yield ["CallSid", "ScenarioName", "Date", "RecordingUrl", "Transcript", "RecordingSid"]
+    
+    for batch in _iter_call_batches(db, filters):
+        messages = defaultdict(list)
+        for msg in db.query(
+            models.Message.call_sid, models.Message.recording_url,
+            models.Message.transcript_text, models.Message.recording_sid
+        ).filter(models.Message.call_sid.in_([c.call_sid for c in batch])).order_by(models.Message.id):
+            messages[msg.call_sid].append(msg)
+        
+        for call in batch:
+            scenario_name = scenario_names.get(call.scenario_id, "Unknown")
+            date_str = call.started_at.strftime("%Y-%m-%d %H:%M:%S")
+            for msg in messages[call.call_sid]:
+                yield [
+                    call.call_sid, scenario_name, date_str,
+                    msg.recording_url or "",
+                    msg.transcript_text or "",
+                    msg.recording_sid or ""
+                ]
+
+def _stream_export_zip(filters: dict, today: str, format: str = "csv"):
+    # The request session is gone once streaming starts, so the generator owns its own
+    db = SessionLocal()
+    try:
+        if format == "parquet":
+            call_sids = select(_filter_calls(db.query(models.Call.call_sid), **filters).subquery().c.call_sid)
+            yield from stream_encrypted_zip(
+                (f"{today}_{name}", chunks) for name, chunks in parquet_export.export_entries(db, call_sids)
+            )
+            return
+        scenario_names = dict(db.query(models.Scenario.id, models.Scenario.name).all())
+        yield from stream_encrypted_zip([
+            (f"{today}_logs.csv", csv_chunks(_export_log_rows(db, filters, scenario_names))),
+            (f"{today}_messages.csv", csv_chunks(_export_message_rows(db, filters, scenario_names))),
+        ])
+    finally:
+        db.close()
+
 @router.get("/export_zip")
 def export_calls_zip(
     to_number: Optional[str] = None,
     from_number: Optional[str] = None,
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
-    scenario_status: str = "active",
+    scenario_status: Optional[str] = None,  # active (default) or deleted; incremental mode: all only
+    watermark: Optional[str] = None,  # incremental mode: name of the consumer's server-side watermark
+    format: str = "csv",              # csv or parquet
     db: Session = Depends(get_db)
 ):
-    import pyzipper
-    from datetime import datetime, timedelta
-    
-    query = db.query(models.Call).options(
-        joinedload(models.Call.answers).joinedload(models.Answer.question),
-        joinedload(models.Call.scenario),
-        joinedload(models.Call.messages)
+    """Encrypted ZIP of call logs and messages.
+
+    format=parquet exports typed, compressed Parquet files instead (calls,
+    answers, messages, transcription_logs; one row per database row) for
+    analytics tools; see app/parquet_export.py.
+
+    With `watermark`, only calls that changed (the call, or any of its answers
+    or messages, e.g. a late transcript) since that watermark's position are
+    exported, in the same format, across all numbers, dates and scenarios: a
+    change outside a narrower filter would otherwise be skipped for good once
+    the watermark passes it. X-Export-Since / X-Export-Until report the window.
+    Downloading doesn't move the watermark; once the archive is safely stored,
+    the consumer confirms it with POST /export_watermarks/{watermark}?until=<X-Export-Until>.
+    Until then every pull re-sends the same changes (plus newer ones).
+    """
+    if watermark:
+        if any([to_number, from_number, start_date, end_date]) or scenario_status not in (None, "all"):
+            raise HTTPException(
+                status_code=400,
+                detail="Incremental exports (watermark) cover every call; drop the number, date and scenario filters"
+            )
+        scenario_status = "all"
+    filters = dict(
+        to_number=to_number, from_number=from_number,
+        start_date=start_date, end_date=end_date,
+        scenario_status=scenario_status or "active",
     )
-    
-    if scenario_status == "active":
-        query = query.join(models.Scenario).filter(models.Scenario.deleted_at.is_(None))
-    elif scenario_status == "deleted":
-        query = query.join(models.Scenario).filter(models.Scenario.deleted_at.isnot(None))
-    
-    if to_number:
-        query = query.filter(models.Call.to_number == to_number)
-    if from_number:
-        query = query.filter(models.Call.from_number == from_number)
-    
-    if start_date:
-        start_dt = datetime.strptime(start_date, "%Y-%m-%d")
-        query = query.filter(models.Call.started_at >= start_dt)
-    if end_date:
-        end_dt = datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=1)
-        query = query.filter(models.Call.started_at < end_dt)
-    
-    calls = query.order_by(models.Call.started_at.desc()).all()
-    
-    # helper for formatting
-    def format_domestic(phone):
-        if not phone: return ""
-        if phone.startswith("+81"): return "0" + phone[3:]
-        return phone
-        
-    stream = io.StringIO()
-    writer = csv.writer(stream)
-    
-    writer.writerow(["CallSid", "Date", "To", "From", "ScenarioName", "Status", "Question", "AnswerType", "Transcript", "RecordingURL"])
-    
-    # Message CSV Stream
-    msg_stream = io.StringIO()
-    msg_writer = csv.writer(msg_stream)
-    msg_writer.writerow(["CallSid", "ScenarioName", "Date", "RecordingUrl", "Transcript", "RecordingSid"])
-    
-    for call in calls:
-        scenario_name = call.scenario.name if call.scenario else "Unknown"
-        date_str = call.started_at.strftime("%Y-%m-%d %H:%M:%S")
-        to_dom = format_domestic(call.to_number)
-        from_dom = format_domestic(call.from_number)
-        
-        # Calls CSV
-        if not call.answers:
-            writer.writerow([
-                call.call_sid, date_str, to_dom, from_dom, 
-                scenario_name, call.status, "-", "-", "-", "-"
-            ])
-        else:
-            for ans in call.answers:
-                q_text = ans.question.text if ans.question else "Unknown"
-                writer.writerow([
-                    call.call_sid, date_str, to_dom, from_dom,
-                    scenario_name, call.status, q_text, ans.answer_type, 
-                    ans.transcript_text or "", 
-                    ans.recording_url_twilio or ""
-                ])
-        
-        # Messages CSV
-        for msg in call.messages:
-             msg_writer.writerow([
-                 call.call_sid, scenario_name, date_str,
-                 msg.recording_url or "",
-                 msg.transcript_text or "",
-                 msg.recording_sid or ""
-             ])
-                
-    # Create ZIP in memory with AES encryption
-    zip_buffer = io.BytesIO()
-    with pyzipper.AESZipFile(zip_buffer, 'w', compression=pyzipper.ZIP_DEFLATED, encryption=pyzipper.WZ_AES) as zf:
-        zf.setpassword(b"attendme")
-        zf.setencryption(pyzipper.WZ_AES, nbits=256)
-        
-        today = datetime.now().strftime("%Y%m%d")
-        csv_filename = f"{today}_logs.csv"
-        zf.writestr(csv_filename, stream.getvalue())
-        
-        msg_filename = f"{today}_messages.csv"
-        zf.writestr(msg_filename, msg_stream.getvalue())
-        
-    zip_buffer.seek(0)
-    
-    filename = f"logs_{datetime.now().strftime('%Y%m%d%H%M')}.zip"
+    # Validate dates before the response starts; errors can't be reported mid-stream
+    _filter_calls(db.query(models.Call), **filters)
+    if format not in ("csv", "parquet"):
+        raise HTTPException(status_code=400, detail="format must be csv or parquet")
+    
+    now = datetime.now()
+    filename = f"logs_{now.strftime('%Y%m%d%H%M')}.zip"
+    headers = {"Content-Disposition": f"attachment; filename={filename}"}
+
+    if watermark:
+        since = db.query(models.ExportWatermark.exported_until).filter(
+            models.ExportWatermark.name == watermark
+        ).scalar()
+        # Stay behind the clock so transactions still in flight (older updated_at, later commit) aren't skipped
+        until = datetime.utcnow() - timedelta(seconds=EXPORT_WATERMARK_LAG_SECONDS)
+        filters.update(changed_since=since, changed_until=until)
+        headers["X-Export-Since"] = since.isoformat() if since else ""
+        headers["X-Export-Until"] = until.isoformat()
     
     return StreamingResponse(
-        zip_buffer,
+        _stream_export_zip(filters, now.strftime("%Y%m%d"), format),
         media_type="application/zip",
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
+        headers=headers
     )
 
+@router.post("/export_watermarks/{name}")
+def confirm_export_watermark(name: str, until: datetime, db: Session = Depends(get_db)):
+    """Advance a consumer's watermark to an export's X-Export-Until once its archive has been received.
+
+    Never moves backwards, so a late or repeated confirmation is harmless.
+    """
+    latest = datetime.utcnow() - timedelta(seconds=EXPORT_WATERMARK_LAG_SECONDS)
+    if until.tzinfo is not None:
+        until = until.astimezone(timezone.utc).replace(tzinfo=None)
+    if until > latest:
+        raise HTTPException(status_code=400, detail="until is later than any export could have covered")
+
+    watermark = db.get(models.ExportWatermark, name)
+    if watermark is None:
+        watermark = models.ExportWatermark(name=name, exported_until=until)
+        db.add(watermark)
+    elif watermark.exported_until is None or watermark.exported_until < until:
+        watermark.exported_until = until
+    db.commit()
+    return {"name": name, "exported_until": watermark.exported_until}
+
 # --- Frontend Render ---
 from fastapi.templating import Jinja2Templates
 templates = Jinja2Templates(directory="app/templates")
@@ -469,22 +716,209 @@ def dashboard_ui(request: Request):
         "now_timestamp": int(time.time())
     })
 # --- Phase 2: Retry Transcription ---
+# Declared before /retranscribe/{answer_id} so "bulk" isn't taken for an answer id
+@router.post("/retranscribe/bulk")
+def bulk_retranscribe(
+    to_number: Optional[str] = None,
+    from_number: Optional[str] = None,
+    start_date: Optional[str] = None,  # YYYY-MM-DD format
+    end_date: Optional[str] = None,    # YYYY-MM-DD format
+    scenario_status: str = "active",   # active or deleted
+    scenario_id: Optional[int] = None,
+    transcript_status: Optional[str] = None,  # usually "failed"; omit for any status
+    rate_per_minute: int = Query(RETRANSCRIBE_BULK_RATE, ge=1),
+    force: bool = False,
+    db: Session = Depends(get_db)
+):
+    """Queue every matching answer, paced at `rate_per_minute`.
+
+    Jobs are committed 500 answers per transaction, so webhook writers never
+    wait long behind this one (SQLite's write gate is a single lock). If a
+    chunk fails, the batch's total is cut back to the answers already queued.
+
+    Jobs are spread out through next_run_at, so the workers (and Whisper) see a
+    steady trickle and new calls' jobs still run first. Answers that already
+    have a queued or running job are skipped. Poll GET /retranscribe/bulk/{batch_id}.
+    """
+    Job = models.TranscriptionJob
+    call_sids = _filter_calls(
+        db.query(models.Call.call_sid), to_number, from_number, start_date, end_date, scenario_status, scenario_id
+    ).subquery()
+    query = db.query(
+        models.Answer.id, models.Answer.recording_sid, models.Answer.call_sid, models.Answer.transcript_status,
+        models.Answer.recording_duration,
+    ).filter(
+        models.Answer.call_sid.in_(select(call_sids.c.call_sid)),
+        models.Answer.recording_sid.isnot(None),
+        ~exists().where(Job.kind == "answer", Job.target_id == models.Answer.id, Job.status.in_(ACTIVE_STATUSES)),
+    )
+    if transcript_status:
+        query = query.filter(models.Answer.transcript_status == transcript_status)
+    answers = query.order_by(models.Answer.id).all()
+
+    batch = models.RetranscriptionBatch(
+        filters=json.dumps({
+            "to_number": to_number, "from_number": from_number, "start_date": start_date, "end_date": end_date,
+            "scenario_status": scenario_status, "scenario_id": scenario_id, "transcript_status": transcript_status,
+        }),
+        total=len(answers),
+        rate_per_minute=rate_per_minute,
+        force=force,
+    )
+    db.add(batch)
+    db.commit()
+    batch_id = batch.id
+
+    now = datetime.utcnow()
+    spacing = timedelta(minutes=1) / rate_per_minute
+    enqueued = 0
+    try:
+        for start in range(0, len(answers), 500):  # also stays under SQLite's bound-parameter limit
+            chunk = answers[start:start + 500]
+            for i, (answer_id, recording_sid, _, _, duration) in enumerate(chunk, start):
+                enqueue_transcription(
+                    db, "answer", answer_id, recording_sid, run_at=now + spacing * i, force=force, batch_id=batch_id,
+                    recording_duration=duration,
+                )
+            stats.transcript_transitions(db, [(call_sid, old, "processing") for _, _, call_sid, old, _ in chunk])
+            db.query(models.Answer).filter(models.Answer.id.in_([answer.id for answer in chunk])).update(
+                {"transcript_status": "processing"}, synchronize_session=False
+            )
+            db.commit()
+            enqueued += len(chunk)
+    except Exception:
+        db.rollback()
+        # The committed chunks stay queued; make the batch's progress reachable
+        db.query(models.RetranscriptionBatch).filter(models.RetranscriptionBatch.id == batch_id).update(
+            {"total": enqueued}, synchronize_session=False
+        )
+        db.commit()
+        if enqueued:
+            notify_workers()
+        raise
+    notify_workers()
+
+    return {
+        "batch_id": batch_id,
+        "total": len(answers),
+        "rate_per_minute": rate_per_minute,
+        "estimated_finish_at": (now + spacing * len(answers)).isoformat(),
+    }
+
+@router.get("/retranscribe/bulk/{batch_id}")
+def read_bulk_retranscribe(batch_id: int, db: Session = Depends(get_db)):
+    """Progress of a bulk retranscription: job counts by status and when the last job is due"""
+    batch = db.query(models.RetranscriptionBatch).filter(models.RetranscriptionBatch.id == batch_id).first()
+    if not batch:
+        raise HTTPException(status_code=404, detail="Batch not found")
+
+    Job = models.TranscriptionJob
+    counts = dict(db.query(Job.status, func.count(Job.id)).filter(Job.batch_id == batch_id).group_by(Job.status).all())
+    last_due = db.query(func.max(Job.next_run_at)).filter(Job.batch_id == batch_id, Job.status == "pending").scalar()
+    done = counts.get("completed", 0) + counts.get("failed", 0)
+    return {
+        "batch_id": batch.id,
+        "created_at": batch.created_at,
+        "filters": json.loads(batch.filters),
+        "rate_per_minute": batch.rate_per_minute,
+        "force": batch.force,
+        "total": batch.total,
+        "pending": counts.get("pending", 0),
+        "running": counts.get("running", 0),
+        "completed": counts.get("completed", 0),
+        "failed": counts.get("failed", 0),
+        "progress": round(done / batch.total, 4) if batch.total else 1.0,
+        "last_job_due_at": last_due,
+    }
+
 @router.post("/retranscribe/{answer_id}")
-async def retry_transcription(answer_id: int, db: Session = Depends(get_db)):
-    from .twilio import transcribe_with_whisper
-    import asyncio
-    
+def retry_transcription(answer_id: int, force: bool = False, db: Session = Depends(get_db)):
+    """Re-run transcription; unchanged audio is answered from the transcript cache unless `force`"""
     answer = db.query(models.Answer).filter(models.Answer.id == answer_id).first()
     if not answer:
         raise HTTPException(status_code=404, detail="Answer not found")
     if not answer.recording_sid:
         raise HTTPException(status_code=400, detail="No recording SID available")
         
+    # Reuse a job that is still queued (repeated clicks) instead of stacking duplicates;
+    # a second job next to a running one would race it to write the transcript
+    job = db.query(models.TranscriptionJob).filter(
+        models.TranscriptionJob.kind == "answer",
+        models.TranscriptionJob.target_id == answer.id,
+        models.TranscriptionJob.status.in_(ACTIVE_STATUSES)
+    ).order_by((models.TranscriptionJob.status == "running").desc()).first()
+    if job and job.status == "running":
+        raise HTTPException(status_code=409, detail="Transcription is already running for this answer")
+
     # Reset status
+    stats.transcript_transitions(db, [(answer.call_sid, answer.transcript_status, "processing")])
     answer.transcript_status = "processing"
-    db.commit()
     
-    # Run async
-    asyncio.create_task(transcribe_with_whisper(answer.id, answer.recording_url_twilio or "", answer.recording_sid))
+    if job:
+        job.next_run_at = datetime.utcnow()
+        job.attempts = 0
+        job.recording_sid = answer.recording_sid
+        job.recording_duration = answer.recording_duration
+        job.force = job.force or force
+    else:
+        enqueue_transcription(
+            db, "answer", answer.id, answer.recording_sid, force=force, recording_duration=answer.recording_duration
+        )
+    db.commit()
+    notify_workers()
     
     return {"message": "Transcription scheduled"}
+
+@router.get("/transcription_jobs/stats")
+def read_transcription_job_stats(db: Session = Depends(get_db)):
+    """Queue depth by status, ready backlog and age of the oldest ready job"""
+    return queue_stats(db)
+
+STATS_GROUP_COLUMNS = ("day", "scenario_id", "to_number")
+
+@router.get("/stats")
+def read_stats(
+    start_date: Optional[str] = None,  # YYYY-MM-DD format
+    end_date: Optional[str] = None,    # YYYY-MM-DD format
+    scenario_id: Optional[int] = None,
+    to_number: Optional[str] = None,
+    group_by: str = "day",             # comma-separated: day, scenario_id, to_number (empty for totals only)
+    db: Session = Depends(get_db)
+):
+    """Dashboard totals from the daily rollups (no scan of calls/answers)"""
+    DS = models.DailyStat
+    group = [g.strip() for g in group_by.split(",") if g.strip()]
+    unknown = set(group) - set(STATS_GROUP_COLUMNS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown group_by: {', '.join(sorted(unknown))}")
+
+    columns = [getattr(DS, g) for g in group]
+    sums = [func.coalesce(func.sum(getattr(DS, c)), 0).label(c) for c in stats.COUNTERS]
+    query = db.query(*columns, *sums)
+    if start_date:
+        query = query.filter(DS.day >= datetime.strptime(start_date, "%Y-%m-%d").date())
+    if end_date:
+        query = query.filter(DS.day <= datetime.strptime(end_date, "%Y-%m-%d").date())
+    if scenario_id is not None:
+        query = query.filter(DS.scenario_id == scenario_id)
+    if to_number:
+        query = query.filter(DS.to_number == to_number)
+
+    if not columns:
+        return {"totals": dict(query.one()._mapping)}
+    rows = [dict(row._mapping) for row in query.group_by(*columns).order_by(*columns)]
+    totals = {c: sum(row[c] for row in rows) for c in stats.COUNTERS}
+    return {"totals": totals, "rows": rows}
+
+@router.post("/stats/rebuild")
+def rebuild_stats(
+    start_date: Optional[str] = None,  # YYYY-MM-DD format
+    end_date: Optional[str] = None,    # YYYY-MM-DD format
+    db: Session = Depends(get_db)
+):
+    """Recompute the rollups from the raw tables (backfill, or repair after manual edits)"""
+    start = datetime.strptime(start_date, "%Y-%m-%d").date() if start_date else None
+    end = datetime.strptime(end_date, "%Y-%m-%d").date() if end_date else None
+    rows = stats.rebuild_daily_stats(db, start, end)
+    db.commit()
+    return {"rows": rows}
@@ -1,232 +1,81 @@
-from fastapi import APIRouter, Request, Depends, Form, HTTPException
+from fastapi import APIRouter, BackgroundTasks, Request, Depends, Form, HTTPException
 from fastapi.responses import Response
 from sqlalchemy.orm import Session
-from twilio.twiml.voice_response import VoiceResponse
-from ..database import get_db
-from .. import models
+from typing import Optional
+from twilio.twiml.voice_response import VoiceResponse, Start
+from ..database import get_db, SessionLocal
+from ..cache import resolve_phone_number, get_compiled_scenario
+from .. import callstatus, models, stats
+from ..jobs import enqueue_transcription, notify_workers
 import os
-import requests
-from openai import OpenAI
 
+# Handlers are plain `def` on purpose: they use the synchronous Session, so FastAPI
+# runs them on the threadpool and a SQLite fsync never stalls the event loop
+# (and the transcription workers running on it).
 router = APIRouter(
     prefix="/twilio",
     tags=["twilio"],
 )
 
-# Initialize OpenAI client
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
 TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
 
-async def transcribe_with_whisper(answer_id: int, recording_url: str, recording_sid: str):
-    """Transcribe audio using OpenAI Whisper API"""
-    import time
-    
-    try:
-        if not OPENAI_API_KEY:
-            print("OpenAI API key not configured")
-            return
-        
-        # Download audio from Twilio with retry logic
-        audio_url = f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_ACCOUNT_SID}/Recordings/{recording_sid}.mp3"
-        
-        max_retries = 5
-        retry_delay = 2  # seconds
-        audio_response = None
-        
-        for attempt in range(max_retries):
-            audio_response = requests.get(audio_url, auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN))
-            
-            if audio_response.status_code == 200:
-                break
-            
-            if attempt < max_retries - 1:
-                print(f"Recording not ready yet (attempt {attempt + 1}/{max_retries}), retrying in {retry_delay}s...")
-                time.sleep(retry_delay)
-                retry_delay *= 2  # Exponential backoff
-            else:
-                print(f"Failed to download recording after {max_retries} attempts: {recording_sid}")
-                return
-        
-        # Save temporarily
-        temp_file = f"/tmp/{recording_sid}.mp3"
-        with open(temp_file, 'wb') as f:
-            f.write(audio_response.content)
-            
-        audio_bytes = os.path.getsize(temp_file)
-        
-        # Transcribe with Whisper
-        start_time = time.time()
-        client = OpenAI(api_key=OPENAI_API_KEY)
-        with open(temp_file, 'rb') as audio_file:
-            # Use verbose_json to get duration
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
-                language="ja",
-                response_format="verbose_json"
-            )
-        processing_time = time.time() - start_time
-        
-        transcript_text = transcript.text
-        audio_duration = getattr(transcript, 'duration', 0)
-        
-        # Update database
-        from ..database import SessionLocal
-        db = SessionLocal()
-        # Phase 2: Guard with recording_sid check to prevent mismatch
-        answer = db.query(models.Answer).filter(
-            models.Answer.id == answer_id,
-            models.Answer.recording_sid == recording_sid
-        ).first()
-        
-        if answer:
-            answer.transcript_text = transcript_text
-            answer.transcript_status = "completed"
-            
-            # Log success with Phase 2 details
-            log_entry = models.TranscriptionLog(
-                answer_id=answer_id,
-                service="openai_whisper",
-                status="success",
-                audio_bytes=audio_bytes,
-                audio_duration=int(audio_duration),
-                model_name="whisper-1",
-                language="ja",
-                request_payload=f"file={recording_sid}.mp3",
-                response_payload=transcript_text[:1000] if transcript_text else "",
-                processing_time=int(processing_time)
-            )
-            db.add(log_entry)
-            
-            db.commit()
-        else:
-            print(f"Warning: Answer mismatch or not found for id={answer_id}, sid={recording_sid}")
+# How the full-call recording is started:
+#   twiml      - <Start><Recording> in the first TwiML response, no REST call (default)
+#   background - REST recordings.create() after the response has been sent
+#   sync       - REST call before responding (old behaviour; caller hears silence meanwhile)
+#   off        - no full-call recording
+CALL_RECORDING_MODE = os.getenv("CALL_RECORDING_MODE", "twiml").lower()
+RECORDING_STATUS_EVENTS = "in-progress completed"
 
-        db.close()
-        
-        # Clean up
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
-        print(f"Transcription completed for {recording_sid}: {transcript_text}")
-        
-    except Exception as e:
-        print(f"Transcription error for {recording_sid}: {str(e)}")
-        # Update status to failed and log
-        from ..database import SessionLocal
-        db = SessionLocal()
-        answer = db.query(models.Answer).filter(
-            models.Answer.id == answer_id,
-            models.Answer.recording_sid == recording_sid
-        ).first()
-        
-        if answer:
-            answer.transcript_status = "failed"
-            
-            # Log failure
-            log_entry = models.TranscriptionLog(
-                answer_id=answer_id,
-                service="openai_whisper",
-                status="failed",
-                audio_bytes=audio_bytes if 'audio_bytes' in locals() else 0,
-                model_name="whisper-1",
-                request_payload=f"file={recording_sid}.mp3",
-                response_payload=str(e),
-                processing_time=0
-            )
-            db.add(log_entry)
-            
-            db.commit()
-        db.close()
-        
-        # Clean up
-        temp_file = f"/tmp/{recording_sid}.mp3"
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
 
-async def transcribe_message_with_whisper(message_id: int, recording_url: str, recording_sid: str):
-    """Transcribe Message audio using OpenAI Whisper API"""
-    import time
-    
+def _start_call_recording(call_sid: str, status_callback: str):
+    """Start the full-call recording through the REST API and store its SID"""
+    from twilio.rest import Client
+
     try:
-        if not OPENAI_API_KEY: return
-        
-        # Download audio from Twilio with retry logic
-        audio_url = f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_ACCOUNT_SID}/Recordings/{recording_sid}.mp3"
-        
-        max_retries = 5
-        retry_delay = 2
-        audio_response = None
-        
-        for attempt in range(max_retries):
-            audio_response = requests.get(audio_url, auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN))
-            if audio_response.status_code == 200: break
-            time.sleep(retry_delay)
-            retry_delay *= 2
-        
-        if not audio_response or audio_response.status_code != 200:
-            print(f"Failed to download message recording: {recording_sid}")
-            return
+        client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+        # POST /2010-04-01/Accounts/{AccountSid}/Calls/{CallSid}/Recordings.json
+        rec = client.calls(call_sid).recordings.create(
+            recording_status_callback=status_callback,
+            recording_status_callback_event=RECORDING_STATUS_EVENTS.split(),
+        )
+    except Exception as e:
+        print(f"Failed to start full call recording: {e}")
+        return None
+    return rec.sid
 
-        temp_file = f"/tmp/msg_{recording_sid}.mp3"
-        with open(temp_file, 'wb') as f:
-            f.write(audio_response.content)
-            
-        # Transcribe
-        client = OpenAI(api_key=OPENAI_API_KEY)
-        with open(temp_file, 'rb') as audio_file:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
-                language="ja"
-            )
-        
-        # Update DB
-        from ..database import SessionLocal
-        db = SessionLocal()
-        msg = db.query(models.Message).filter(models.Message.id == message_id).first()
-        if msg:
-            msg.transcript_text = transcript.text
-            db.commit()
+
+def _start_call_recording_in_background(call_sid: str, status_callback: str):
+    recording_sid = _start_call_recording(call_sid, status_callback)
+    if not recording_sid:
+        return
+    # The status callback back-fills it as well; whichever lands first wins
+    db = SessionLocal()
+    try:
+        _set_call_recording_sid(db, call_sid, recording_sid)
+        db.commit()
+    finally:
         db.close()
-        
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
-            
-    except Exception as e:
-        print(f"Message transcription error: {e}")
-        # Clean up
-        temp_file = f"/tmp/msg_{recording_sid}.mp3"
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
+
+
+def _set_call_recording_sid(db: Session, call_sid: str, recording_sid: str):
+    db.query(models.Call).filter(
+        models.Call.call_sid == call_sid,
+        models.Call.recording_sid.is_(None),
+    ).update({"recording_sid": recording_sid}, synchronize_session=False)
 
 @router.post("/voice")
-async def handle_incoming_call(
+def handle_incoming_call(
     request: Request,
+    background_tasks: BackgroundTasks,
     To: str = Form(...),
     From: str = Form(...),
     CallSid: str = Form(...),
     db: Session = Depends(get_db)
 ):
-    from twilio.rest import Client
-    
-    # Normalize phone number
-    def normalize_phone(number):
-        normalized = number.replace(' ', '').replace('-', '').replace('(', '').replace(')', '')
-        if not normalized.startswith('+'):
-            normalized = '+' + normalized
-        return normalized
-    
-    to_normalized = normalize_phone(To)
-    
-    # 1. Lookup Scenario
-    phone_entry = db.query(models.PhoneNumber).filter(models.PhoneNumber.to_number == To).first()
-    if not phone_entry:
-        all_numbers = db.query(models.PhoneNumber).all()
-        for pn in all_numbers:
-            if normalize_phone(pn.to_number) == to_normalized:
-                phone_entry = pn
-                break
+    # 1. Lookup Scenario (normalized number index + in-process cache)
+    resolved = resolve_phone_number(db, To)
     
     # Create Call record (initial)
     call = models.Call(
@@ -234,33 +83,41 @@ async def handle_incoming_call(
         from_number=From,
         to_number=To,
         status="in-progress",
-        scenario_id=phone_entry.scenario_id if phone_entry else None
+        scenario_id=resolved.scenario_id if resolved else None
     )
     
-    # 2. Start Full Call Recording
-    recording_sid = None
-    if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN:
-        try:
-            client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-            # Create a recording for the call (in-progress)
-            # Twilio API: POST /2010-04-01/Accounts/{AccountSid}/Calls/{CallSid}/Recordings.json
-            rec = client.calls(CallSid).recordings.create()
-            recording_sid = rec.sid
-            call.recording_sid = recording_sid
-        except Exception as e:
-            print(f"Failed to start full call recording: {e}")
+    scenario = None
+    if resolved and resolved.is_active:
+        scenario = get_compiled_scenario(db, resolved.scenario_id)
+
+    # 2. Start Full Call Recording (Call.recording_sid is back-filled by /recording_status),
+    # only for calls that reach a scenario: unregistered/inactive numbers aren't recorded or billed
+    vr = VoiceResponse()
+    has_credentials = bool(TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN)
+    if scenario and CALL_RECORDING_MODE == "twiml":
+        start = Start()
+        start.recording(
+            recording_status_callback="/twilio/recording_status",
+            recording_status_callback_event=RECORDING_STATUS_EVENTS,
+        )
+        vr.append(start)
+    elif scenario and CALL_RECORDING_MODE == "background" and has_credentials:
+        # Twilio needs an absolute callback URL for REST-created recordings
+        background_tasks.add_task(
+            _start_call_recording_in_background, CallSid, str(request.url_for("handle_recording_status"))
+        )
+    elif scenario and CALL_RECORDING_MODE == "sync" and has_credentials:
+        call.recording_sid = _start_call_recording(CallSid, str(request.url_for("handle_recording_status")))
 
     db.add(call)
+    db.flush()
+    stats.bump(db, stats.key_for_call(call), calls=1)
     db.commit()
 
-    vr = VoiceResponse()
-
-    if not phone_entry or not phone_entry.scenario.is_active:
+    if not scenario:
         vr.say("現在この番号は使われておりません。", language="ja-JP")
         return Response(content=str(vr), media_type="application/xml")
 
-    scenario = phone_entry.scenario
-
     # 3. Greeting
     if scenario.greeting_text:
         vr.say(scenario.greeting_text, language="ja-JP")
@@ -274,14 +131,14 @@ async def handle_incoming_call(
     vr.pause(length=1.5)
 
     # 5. Ask First Question
-    first_question = db.query(models.Question).filter(
-        models.Question.scenario_id == scenario.id,
-        models.Question.is_active == True
-    ).order_by(models.Question.sort_order).first()
+    first_question = scenario.first_question()
 
     if first_question:
         vr.say(first_question.text, language="ja-JP")
-        action_url = f"/twilio/record_callback?scenario_id={scenario.id}&q_curr={first_question.id}"
+        # The call's rollup key rides along in the action URLs (scenario_id, day; Twilio sends To),
+        # so the recording webhooks never need to read the call back
+        day = stats.key_for_call(call)[0].isoformat()
+        action_url = f"/twilio/record_callback?scenario_id={scenario.id}&q_curr={first_question.id}&day={day}"
         vr.record(
             action=action_url, 
             finish_on_key="#",
@@ -290,13 +147,9 @@ async def handle_incoming_call(
         )
     else:
         # Check for Ending Guidance if no questions?
-        ending_guidances = db.query(models.EndingGuidance).filter(
-            models.EndingGuidance.scenario_id == scenario.id
-        ).order_by(models.EndingGuidance.sort_order).all()
-        
-        if ending_guidances:
-             for eg in ending_guidances:
-                 vr.say(eg.text, language="ja-JP")
+        if scenario.ending_guidances:
+             for eg_text in scenario.ending_guidances:
+                 vr.say(eg_text, language="ja-JP")
                  vr.pause(length=1)
         else:
             vr.say("終了します。", language="ja-JP")
@@ -304,17 +157,21 @@ async def handle_incoming_call(
     return Response(content=str(vr), media_type="application/xml")
 
 @router.post("/record_callback")
-async def handle_recording(
+def handle_recording(
     request: Request,
     scenario_id: int,
     q_curr: int, 
+    day: Optional[str] = None,
     CallSid: str = Form(...),
+    To: Optional[str] = Form(None),
     RecordingUrl: str = Form(...),
     RecordingSid: str = Form(...),
+    RecordingDuration: Optional[int] = Form(None),
     db: Session = Depends(get_db)
 ):
-    # Get current question for sort_order
-    current_q = db.query(models.Question).get(q_curr)
+    # Get current question for sort_order (from the compiled call flow, no query)
+    scenario = get_compiled_scenario(db, scenario_id)
+    current_q = scenario.get_question(q_curr) if scenario else None
     
     # 1. Save Answer
     answer = models.Answer(
@@ -323,34 +180,33 @@ async def handle_recording(
         answer_type="recording",
         recording_sid=RecordingSid,
         recording_url_twilio=RecordingUrl,
+        recording_duration=RecordingDuration,
         transcript_status="processing",
         question_sort_at_call=current_q.sort_order if current_q else 0
     )
     db.add(answer)
-    db.commit()
-    db.refresh(answer)
+    db.flush()
     
-    # 2. Transcribe (async)
-    import asyncio
-    asyncio.create_task(transcribe_with_whisper(answer.id, RecordingUrl, RecordingSid))
+    # 2. Transcribe (durable job in the same transaction, run by the transcription workers)
+    enqueue_transcription(db, "answer", answer.id, RecordingSid, recording_duration=RecordingDuration)
+    stats.bump_for_call(db, CallSid, stats.key_for_webhook(day, scenario_id, To), answers=1)
+    db.commit()
+    notify_workers()
 
     vr = VoiceResponse()
+    day_param = f"&day={day}" if day else ""
 
     # 3. Find Next Question
     if not current_q:
         vr.say("エラーが発生しました。", language="ja-JP")
         return Response(content=str(vr), media_type="application/xml")
 
-    next_question = db.query(models.Question).filter(
-        models.Question.scenario_id == scenario_id,
-        models.Question.is_active == True,
-        models.Question.sort_order > current_q.sort_order
-    ).order_by(models.Question.sort_order).first()
+    next_question = scenario.next_question(current_q)
 
     if next_question:
         # Ask next
         vr.say(next_question.text, language="ja-JP")
-        action_url = f"/twilio/record_callback?scenario_id={scenario_id}&q_curr={next_question.id}"
+        action_url = f"/twilio/record_callback?scenario_id={scenario_id}&q_curr={next_question.id}{day_param}"
         vr.record(
             action=action_url, 
             finish_on_key="#",
@@ -361,7 +217,7 @@ async def handle_recording(
         # Phase 4: Message Recording
         vr.say("担当者に伝えたいことがあればお話しください。終わったらシャープを押してください。", language="ja-JP")
         vr.record(
-            action=f"/twilio/message_record?scenario_id={scenario_id}",
+            action=f"/twilio/message_record?scenario_id={scenario_id}{day_param}",
             finish_on_key="#",
             timeout=10,
             max_length=180
@@ -370,12 +226,15 @@ async def handle_recording(
     return Response(content=str(vr), media_type="application/xml")
 
 @router.post("/message_record")
-async def handle_message_recording(
+def handle_message_recording(
     request: Request,
     scenario_id: int,
+    day: Optional[str] = None,
     CallSid: str = Form(...),
+    To: Optional[str] = Form(None),
     RecordingUrl: str = Form(...),
     RecordingSid: str = Form(...),
+    RecordingDuration: Optional[int] = Form(None),
     db: Session = Depends(get_db)
 ):
     # Save Message
@@ -383,44 +242,49 @@ async def handle_message_recording(
         call_sid=CallSid,
         recording_sid=RecordingSid,
         recording_url=RecordingUrl,
+        recording_duration=RecordingDuration,
         transcript_text="(文字起こし中...)"
     )
     db.add(msg)
-    db.commit()
-    db.refresh(msg)
+    db.flush()
     
-    # Async transcribe
-    import asyncio
-    asyncio.create_task(transcribe_message_with_whisper(msg.id, RecordingUrl, RecordingSid))
+    # Async transcribe (durable job)
+    enqueue_transcription(db, "message", msg.id, RecordingSid, recording_duration=RecordingDuration)
+    stats.bump_for_call(db, CallSid, stats.key_for_webhook(day, scenario_id, To), messages=1)
+    db.commit()
+    notify_workers()
     
     vr = VoiceResponse()
+    day_param = f"&day={day}" if day else ""
     vr.say("録音を受け付けました。", language="ja-JP")
     
     # Confirm
     from twilio.twiml.voice_response import Gather
-    gather = Gather(num_digits=1, action=f"/twilio/message_confirm?scenario_id={scenario_id}", timeout=10)
+    gather = Gather(num_digits=1, action=f"/twilio/message_confirm?scenario_id={scenario_id}{day_param}", timeout=10)
     gather.say("他にお話しすることはありますか？ ある場合は、1を。終わる場合は、2、またはそのままお待ちください。", language="ja-JP")
     vr.append(gather)
     
     # If no input, default to end (2)
-    vr.redirect(f"/twilio/message_confirm?scenario_id={scenario_id}&Digits=2")
+    vr.redirect(f"/twilio/message_confirm?scenario_id={scenario_id}{day_param}&Digits=2")
     
     return Response(content=str(vr), media_type="application/xml")
 
 @router.post("/message_confirm")
-async def handle_message_confirm(
+def handle_message_confirm(
     request: Request,
     scenario_id: int,
+    day: Optional[str] = None,
     Digits: str = Form("2"),
     db: Session = Depends(get_db)
 ):
     vr = VoiceResponse()
+    day_param = f"&day={day}" if day else ""
     
     if Digits == "1":
         # Retry recording
         vr.say("担当者に伝えたいことがあればお話しください。終わったらシャープを押してください。", language="ja-JP")
         vr.record(
-            action=f"/twilio/message_record?scenario_id={scenario_id}",
+            action=f"/twilio/message_record?scenario_id={scenario_id}{day_param}",
             finish_on_key="#",
             timeout=10,
             max_length=180
@@ -428,13 +292,11 @@ async def handle_message_confirm(
         return Response(content=str(vr), media_type="application/xml")
     
     # End
-    ending_guidances = db.query(models.EndingGuidance).filter(
-        models.EndingGuidance.scenario_id == scenario_id
-    ).order_by(models.EndingGuidance.sort_order).all()
+    scenario = get_compiled_scenario(db, scenario_id)
     
-    if ending_guidances:
-        for eg in ending_guidances:
-            vr.say(eg.text, language="ja-JP")
+    if scenario and scenario.ending_guidances:
+        for eg_text in scenario.ending_guidances:
+            vr.say(eg_text, language="ja-JP")
             vr.pause(length=1)
     else:
         vr.say("お問い合わせありがとうございました。", language="ja-JP")
@@ -444,11 +306,50 @@ async def handle_message_confirm(
     
     return Response(content=str(vr), media_type="application/xml")
 
+@router.post("/recording_status")
+def handle_recording_status(
+    CallSid: str = Form(...),
+    RecordingSid: str = Form(...),
+    RecordingStatus: str = Form(None),
+    db: Session = Depends(get_db)
+):
+    # Only the full-call recording reports here; <Record> answers come through their action URLs
+    if RecordingStatus != "failed":
+        _set_call_recording_sid(db, CallSid, RecordingSid)
+        db.commit()
+    else:
+        print(f"Full call recording {RecordingSid} failed for {CallSid}")
+    return Response(status_code=204)
+
+@router.post("/status_callback")
+async def handle_status_callback(
+    CallSid: str = Form(...),
+    CallStatus: Optional[str] = Form(None),
+    CallDuration: Optional[int] = Form(None),
+    Timestamp: Optional[str] = Form(None),
+    RecordingSid: Optional[str] = Form(None),
+    RecordingStatus: Optional[str] = Form(None),
+):
+    """Call-status (and full-call recording-status) events; set as the number's status callback URL.
+
+    `async` because it never touches the database: the event is buffered and
+    written with others in a batch by callstatus.buffer.
+    """
+    recording_sid = RecordingSid if RecordingSid and RecordingStatus != "failed" else None
+    await callstatus.buffer.add(callstatus.CallStatusEvent(
+        CallSid,
+        CallStatus,
+        CallDuration,
+        callstatus.parse_timestamp(Timestamp),
+        recording_sid,
+    ))
+    return Response(status_code=204)
+
 # Keep transcription_callback for safety/legacy? Or remove? 
 # The user wants Whisper, so native transcription is likely disabled or ignored.
 # We will keep it but it does nothing if we don't enable it in vr.record parameters (transcribe=True is default false).
 @router.post("/transcription_callback")
-async def handle_transcription(
+def handle_transcription(
     request: Request,
     TranscriptionText: str = Form(None),
     RecordingSid: str = Form(...),
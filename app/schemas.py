@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Literal, Optional
 from datetime import datetime
 
 # --- EndingGuidance Schemas ---
@@ -25,6 +25,7 @@ class ScenarioBase(BaseModel):
     disclaimer_text: Optional[str] = None
     question_guidance_text: Optional[str] = None
     is_active: bool = True
+    transcription_backend: Optional[Literal["openai", "local", "fake"]] = None  # None = global routing
 
 class ScenarioCreate(ScenarioBase):
     pass
@@ -104,6 +105,8 @@ class CallLog(BaseModel):
     status: str
     recording_sid: Optional[str]
     started_at: datetime
+    ended_at: Optional[datetime] = None
+    duration: Optional[int] = None
     answers: List[AnswerLog] = []
     messages: List[MessageLog] = []
 
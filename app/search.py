@@ -0,0 +1,183 @@
+"""Full-text search over answer and message transcripts.
+
+SQLite: an FTS5 table with the trigram tokenizer (Japanese has no spaces to
+split words on, so every 3-character substring is indexed). Triggers keep it
+in step with answers/messages.transcript_text, so every path that writes a
+transcript (results, retranscription, manual fixes) updates the index in the
+same transaction. Rows are keyed by rowid = id * 2 (+1 for messages), which
+makes the trigger's delete an index lookup.
+
+Postgres: pg_trgm GIN indexes on the transcript columns themselves; ILIKE
+uses them directly and similarity() ranks the hits.
+
+Terms shorter than 3 characters can't use a trigram index; they narrow the
+indexed matches, or fall back to a LIKE scan when the query has nothing else.
+"""
+from typing import List, NamedTuple, Optional
+
+from sqlalchemy import column, func, literal, literal_column, table, text, union_all
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+
+from . import models
+from .stats import MESSAGE_FAILED_TEXT, MESSAGE_PENDING_TEXT
+
+MIN_TRIGRAM_TERM = 3
+
+transcript_fts = table("transcript_fts", column("rowid"), column("text"), column("call_sid"))
+
+# Set by install(): "fts5", "pg_trgm", or None for an unindexed LIKE scan over the base tables
+_index: Optional[str] = None
+
+# (table, rowid offset, which transcripts are worth indexing)
+_SOURCES = [
+    ("answers", 0, "{row}.transcript_text IS NOT NULL AND {row}.transcript_text != ''"),
+    ("messages", 1, "{row}.transcript_text IS NOT NULL AND {row}.transcript_text != ''"
+                    f" AND {{row}}.transcript_text NOT IN ('{MESSAGE_PENDING_TEXT}', '{MESSAGE_FAILED_TEXT}')"),
+]
+
+
+def _sqlite_triggers(source: str, offset: int, indexable: str) -> List[str]:
+    new_row = f"INSERT INTO transcript_fts(rowid, text, call_sid) SELECT new.id * 2 + {offset}, new.transcript_text, new.call_sid"
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS {source}_fts_insert AFTER INSERT ON {source} BEGIN
+            {new_row} WHERE {indexable.format(row="new")};
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {source}_fts_update AFTER UPDATE OF transcript_text, call_sid ON {source} BEGIN
+            DELETE FROM transcript_fts WHERE rowid = old.id * 2 + {offset};
+            {new_row} WHERE {indexable.format(row="new")};
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {source}_fts_delete AFTER DELETE ON {source} BEGIN
+            DELETE FROM transcript_fts WHERE rowid = old.id * 2 + {offset};
+        END""",
+    ]
+
+
+class SearchHit(NamedTuple):
+    kind: str  # "answer" or "message"
+    id: int
+    call_sid: str
+    text: str
+
+
+def install(engine):
+    """Create the search index for this database (idempotent; backfills a new FTS table)"""
+    global _index
+    if engine.dialect.name == "postgresql":
+        try:
+            with engine.begin() as conn:
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                for source in ("answers", "messages"):
+                    conn.execute(text(
+                        f"CREATE INDEX IF NOT EXISTS ix_{source}_transcript_trgm "
+                        f"ON {source} USING gin (transcript_text gin_trgm_ops)"
+                    ))
+            _index = "pg_trgm"
+        except DBAPIError as e:
+            print(f"Transcript search: pg_trgm unavailable, searches will scan ({e})")
+        return
+
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.begin() as conn:
+        exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'transcript_fts'")).first()
+        if not exists:
+            try:
+                conn.execute(text(
+                    "CREATE VIRTUAL TABLE transcript_fts USING fts5(text, call_sid UNINDEXED, tokenize='trigram')"
+                ))
+            except DBAPIError as e:
+                print(f"Transcript search: FTS5 trigram tokenizer unavailable, searches will scan ({e})")
+                return
+            for source, offset, indexable in _SOURCES:
+                conn.execute(text(
+                    f"INSERT INTO transcript_fts(rowid, text, call_sid) SELECT id * 2 + {offset}, transcript_text, call_sid "
+                    f"FROM {source} WHERE {indexable.format(row=source)}"
+                ))
+        for source, offset, indexable in _SOURCES:
+            for trigger in _sqlite_triggers(source, offset, indexable):
+                conn.execute(text(trigger))
+    _index = "fts5"
+
+
+def _like_pattern(term: str) -> str:
+    return "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def _fts_phrase(term: str) -> str:
+    return '"' + term.replace('"', '""') + '"'
+
+
+def search_transcripts(db: Session, q: str, call_sids=None, limit: int = 50, offset: int = 0) -> List[SearchHit]:
+    """Transcripts containing every whitespace-separated term of `q`, best match first.
+
+    `call_sids` optionally restricts hits to a select of call SIDs (the dashboard's call filters).
+    """
+    terms = q.split()
+    if not terms:
+        return []
+    if _index == "fts5":
+        return _search_fts(db, terms, call_sids, limit, offset)
+    return _search_columns(db, terms, call_sids, limit, offset)
+
+
+def _search_fts(db: Session, terms, call_sids, limit, offset) -> List[SearchHit]:
+    fts = transcript_fts
+    query = db.query(fts.c.rowid, fts.c.call_sid, fts.c.text)
+
+    indexed = [t for t in terms if len(t) >= MIN_TRIGRAM_TERM]
+    if indexed:
+        query = query.filter(literal_column("transcript_fts").op("MATCH")(" ".join(_fts_phrase(t) for t in indexed)))
+        query = query.order_by(literal_column("rank"), fts.c.rowid.desc())
+    else:
+        query = query.order_by(fts.c.rowid.desc())
+    for term in terms:
+        if len(term) < MIN_TRIGRAM_TERM:
+            query = query.filter(fts.c.text.like(_like_pattern(term), escape="\\"))
+    if call_sids is not None:
+        query = query.filter(fts.c.call_sid.in_(call_sids))
+
+    return [
+        SearchHit("message" if rowid % 2 else "answer", rowid // 2, call_sid, transcript)
+        for rowid, call_sid, transcript in query.limit(limit).offset(offset)
+    ]
+
+
+def _search_columns(db: Session, terms, call_sids, limit, offset) -> List[SearchHit]:
+    """(I)LIKE over the transcript columns: pg_trgm-indexed and ranked on Postgres, a scan elsewhere"""
+    postgres = db.get_bind().dialect.name == "postgresql"
+    selects = []
+    for kind, model in (("answer", models.Answer), ("message", models.Message)):
+        score = func.similarity(model.transcript_text, " ".join(terms)) if _index == "pg_trgm" else literal(0)
+        select_ = db.query(
+            literal(kind).label("kind"), model.id.label("id"), model.call_sid.label("call_sid"),
+            model.transcript_text.label("text"), score.label("score"),
+        )
+        for term in terms:
+            pattern = _like_pattern(term)
+            column_ = model.transcript_text
+            select_ = select_.filter(column_.ilike(pattern, escape="\\") if postgres else column_.like(pattern, escape="\\"))
+        if model is models.Message:
+            select_ = select_.filter(model.transcript_text.notin_([MESSAGE_PENDING_TEXT, MESSAGE_FAILED_TEXT]))
+        if call_sids is not None:
+            select_ = select_.filter(model.call_sid.in_(call_sids))
+        selects.append(select_.statement)
+
+    hits = union_all(*selects).subquery()
+    rows = db.query(hits.c.kind, hits.c.id, hits.c.call_sid, hits.c.text).order_by(
+        hits.c.score.desc(), hits.c.id.desc()
+    ).limit(limit).offset(offset)
+    return [SearchHit(*row) for row in rows]
+
+
+def snippet(transcript: Optional[str], terms: List[str], width: int = 40) -> str:
+    """`width` characters either side of the first matched term"""
+    transcript = transcript or ""
+    lowered = transcript.lower()
+    positions = [lowered.find(t.lower()) for t in terms]
+    positions = [p for p in positions if p >= 0]
+    if not positions:
+        return transcript[:width * 2]
+    start = max(0, min(positions) - width)
+    end = min(len(transcript), min(positions) + width)
+    return ("…" if start else "") + transcript[start:end] + ("…" if end < len(transcript) else "")
@@ -0,0 +1,198 @@
+"""Daily rollups per (day, scenario, dialed number) for the dashboard's totals and charts.
+
+Counters are bumped in the same transaction as the write they describe
+(webhooks, transcript results, retranscribe requests), so /admin/stats reads
+a few hundred pre-aggregated rows instead of scanning calls and answers.
+Transcript counters track current state: an answer that failed and later
+succeeds moves from transcripts_failed to transcripts_completed.
+
+`rebuild_daily_stats` recomputes a date range from the raw tables; it
+backfills existing databases and repairs any drift.
+"""
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import case, func, literal, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import SessionLocal
+
+COUNTERS = ("calls", "answers", "messages", "transcripts_completed", "transcripts_failed")
+NO_SCENARIO = 0  # scenario_id for calls to unmapped numbers (NULL would defeat the unique key)
+
+# Message rows carry their state in transcript_text
+MESSAGE_PENDING_TEXT = "(文字起こし中...)"
+MESSAGE_FAILED_TEXT = "(文字起こし失敗)"
+
+StatKey = Tuple[date, int, str]
+
+
+def key_for_call(call: models.Call) -> StatKey:
+    return _key(call.started_at, call.scenario_id, call.to_number)
+
+
+def _key(started_at: Optional[datetime], scenario_id: Optional[int], to_number: Optional[str]) -> StatKey:
+    return ((started_at or datetime.utcnow()).date(), scenario_id or NO_SCENARIO, to_number or "")
+
+
+def keys_for_calls(db: Session, call_sids: Iterable[str]) -> Dict[str, StatKey]:
+    call_sids = list(set(call_sids))
+    keys = {}
+    for start in range(0, len(call_sids), 500):
+        rows = db.query(models.Call.call_sid, models.Call.started_at, models.Call.scenario_id, models.Call.to_number).filter(
+            models.Call.call_sid.in_(call_sids[start:start + 500])
+        )
+        keys.update({sid: _key(started_at, scenario_id, to_number) for sid, started_at, scenario_id, to_number in rows})
+    return keys
+
+
+def key_for_webhook(day: Optional[str], scenario_id: Optional[int], to_number: Optional[str]) -> Optional[StatKey]:
+    """The call's key rebuilt from what later webhooks already carry: the `day` the /voice
+    webhook put in the TwiML action URLs, the scenario_id there and Twilio's To parameter.
+    None when any is missing (calls that started before the URLs carried a day)."""
+    if not day or to_number is None:
+        return None
+    try:
+        return (date.fromisoformat(day), scenario_id or NO_SCENARIO, to_number)
+    except ValueError:
+        return None
+
+
+def bump_for_call(db: Session, call_sid: str, key: Optional[StatKey] = None, **deltas: int):
+    """Bump the call's rollup row; pass `key` (key_for_webhook) to skip looking the call up"""
+    if key is None:
+        key = keys_for_calls(db, [call_sid]).get(call_sid)
+    if key is not None:
+        bump(db, key, **deltas)
+
+
+def bump(db: Session, key: StatKey, **deltas: int):
+    """Add `deltas` to the key's counters (upsert, so concurrent writers don't lose increments)"""
+    deltas = {k: v for k, v in deltas.items() if v}
+    if not deltas:
+        return
+    DS = models.DailyStat
+    day, scenario_id, to_number = key
+    insert = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}.get(db.get_bind().dialect.name)
+    if insert is None:
+        row = db.query(DS).filter(DS.day == day, DS.scenario_id == scenario_id, DS.to_number == to_number).first()
+        if row is None:
+            row = DS(day=day, scenario_id=scenario_id, to_number=to_number, **{c: 0 for c in COUNTERS})
+            db.add(row)
+            db.flush()
+        for name, delta in deltas.items():
+            setattr(row, name, getattr(DS, name) + delta)
+        return
+
+    stmt = insert(DS).values(day=day, scenario_id=scenario_id, to_number=to_number,
+                             **{c: deltas.get(c, 0) for c in COUNTERS})
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=["day", "scenario_id", "to_number"],
+        set_={name: getattr(DS, name) + delta for name, delta in deltas.items()},
+    ))
+
+
+def _transcript_counter(status: Optional[str]) -> Optional[str]:
+    return {"completed": "transcripts_completed", "failed": "transcripts_failed"}.get(status)
+
+
+def transcript_transitions(db: Session, changes: Iterable[Tuple[str, Optional[str], Optional[str]]]):
+    """Apply (call_sid, old_status, new_status) transcript changes to the rollups in one pass"""
+    changes = [c for c in changes if _transcript_counter(c[1]) != _transcript_counter(c[2])]
+    if not changes:
+        return
+    keys = keys_for_calls(db, (call_sid for call_sid, _, _ in changes))
+    deltas = defaultdict(lambda: defaultdict(int))
+    for call_sid, old, new in changes:
+        key = keys.get(call_sid)
+        if key is None:
+            continue
+        if _transcript_counter(old):
+            deltas[key][_transcript_counter(old)] -= 1
+        if _transcript_counter(new):
+            deltas[key][_transcript_counter(new)] += 1
+    for key, counters in deltas.items():
+        bump(db, key, **counters)
+
+
+def message_status(transcript_text: Optional[str]) -> Optional[str]:
+    if transcript_text == MESSAGE_PENDING_TEXT:
+        return "processing"
+    if transcript_text == MESSAGE_FAILED_TEXT:
+        return "failed"
+    return "completed" if transcript_text is not None else None
+
+
+def rebuild_daily_stats(db: Session, start: Optional[date] = None, end: Optional[date] = None) -> int:
+    """Recompute rollups for calls started in [start, end] (inclusive; open-ended if omitted).
+
+    The caller commits. Returns the number of rollup rows written.
+
+    The old rows are deleted before the counts are read, in the same
+    transaction, so webhook bumps wait behind the rebuild instead of landing
+    between the reads and the delete and being wiped: the delete takes
+    SQLite's write gate, and on Postgres daily_stats is locked against writers.
+    """
+    Call, Answer, Message, DS = models.Call, models.Answer, models.Message, models.DailyStat
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(text("LOCK TABLE daily_stats IN EXCLUSIVE MODE"))
+    stale = db.query(DS)
+    if start:
+        stale = stale.filter(DS.day >= start)
+    if end:
+        stale = stale.filter(DS.day <= end)
+    stale.delete(synchronize_session=False)
+
+    day = func.date(Call.started_at)
+
+    group = (day, Call.scenario_id, Call.to_number)
+    totals = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+
+    def add(counted, state, counters_for_state, join=None):
+        query = db.query(*group, state, func.count(counted))
+        if join is not None:
+            query = query.join(*join)
+        if start:
+            query = query.filter(Call.started_at >= datetime.combine(start, datetime.min.time()))
+        if end:
+            query = query.filter(Call.started_at < datetime.combine(end + timedelta(days=1), datetime.min.time()))
+        for day_value, scenario_id, to_number, state_value, count in query.group_by(*group, state):
+            counts = totals[(_as_date(day_value), scenario_id or NO_SCENARIO, to_number or "")]
+            for counter in counters_for_state(state_value):
+                if counter:
+                    counts[counter] += count
+
+    message_state = case(
+        (Message.transcript_text == MESSAGE_FAILED_TEXT, "failed"),
+        (Message.transcript_text == MESSAGE_PENDING_TEXT, "processing"),
+        (Message.transcript_text.is_(None), "pending"),
+        else_="completed",
+    )
+    add(Call.call_sid, literal("call"), lambda _: ["calls"])
+    add(Answer.id, Answer.transcript_status, lambda st: ["answers", _transcript_counter(st)],
+        join=(Answer, Answer.call_sid == Call.call_sid))
+    add(Message.id, message_state, lambda st: ["messages", _transcript_counter(st)],
+        join=(Message, Message.call_sid == Call.call_sid))
+
+    db.add_all(DS(day=d, scenario_id=s, to_number=n, **counts) for (d, s, n), counts in totals.items())
+    return len(totals)
+
+
+def backfill_daily_stats():
+    """Build the rollups once for a database that predates them"""
+    db = SessionLocal()
+    try:
+        if db.query(models.DailyStat.id).first() is None and db.query(models.Call.call_sid).first() is not None:
+            rows = rebuild_daily_stats(db)
+            db.commit()
+            print(f"Backfilled {rows} daily stat rows")
+    finally:
+        db.close()
+
+
+def _as_date(value) -> date:
+    # func.date() comes back as a string on SQLite and a date on Postgres
+    return date.fromisoformat(value) if isinstance(value, str) else value
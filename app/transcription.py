@@ -0,0 +1,495 @@
+"""Transcription for answer and message recordings.
+
+Everything here runs on the event loop without blocking it: recordings are
+streamed from Twilio with httpx.AsyncClient into a per-job spooled buffer,
+retry backoff uses asyncio.sleep, the speech-to-text call goes to the backend
+chosen for the recording (app/backends.py: Whisper API, local model, fake)
+and results are handed back to the job queue, which writes them in batches.
+TRANSCRIPTION_CONCURRENCY caps how many Twilio downloads (and Whisper API
+requests) run at once per worker.
+"""
+import asyncio
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+import wave
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional, Sequence
+
+import httpx
+from sqlalchemy import func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from . import metrics, models, stats
+from .audio import Chunk, plan_chunks, read_wav
+from .backends import (
+    WHISPER_LANGUAGE, WHISPER_MODEL, RateLimited, TranscriptionBackend, TranscriptionError, choose_backend,
+)
+from .database import SessionLocal
+from .recordings import RecordingNotFound, get_cached_recording, recording_url
+
+TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
+TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
+
+TRANSCRIPTION_CONCURRENCY = int(os.getenv("TRANSCRIPTION_CONCURRENCY", "8"))
+DOWNLOAD_MAX_RETRIES = int(os.getenv("TRANSCRIPTION_DOWNLOAD_RETRIES", "5"))
+DOWNLOAD_TIMEOUT = float(os.getenv("TRANSCRIPTION_DOWNLOAD_TIMEOUT", "30"))
+# Recordings up to this size stay in memory; larger ones spill to an anonymous temp file
+AUDIO_SPOOL_MAX_BYTES = int(os.getenv("AUDIO_SPOOL_MAX_BYTES", str(4 * 1024 * 1024)))
+# Whisper rejects uploads over 25 MB, so stop downloading at that point
+AUDIO_MAX_BYTES = int(os.getenv("AUDIO_MAX_BYTES", str(25 * 1024 * 1024)))
+
+# Transcript cache keyed by (recording SID, audio SHA-256, model, language)
+TRANSCRIPT_CACHE_MAX_ROWS = int(os.getenv("TRANSCRIPT_CACHE_MAX_ROWS", "50000"))
+TRANSCRIPT_CACHE_TTL_DAYS = int(os.getenv("TRANSCRIPT_CACHE_TTL_DAYS", "90"))
+
+# Recordings at least this long are trimmed, split at pauses and transcribed in parallel
+CHUNKED_MIN_SECONDS = float(os.getenv("TRANSCRIPTION_CHUNKED_MIN_SECONDS", "45"))
+
+
+class TranscriptionEngine:
+    """Owns the shared Twilio HTTP client and the download concurrency limit.
+
+    The client and semaphore belong to the event loop they were created on,
+    so they are (re)built lazily the first time a new loop uses the engine.
+    """
+
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self._loop = None
+        self._semaphore = None
+        self._http = None
+
+    def _bind(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._http = httpx.AsyncClient(timeout=DOWNLOAD_TIMEOUT)
+
+    async def download_recording(self, recording_sid: str, fmt: str = "mp3") -> Optional["AudioBuffer"]:
+        """Stream the recording (mp3 or wav) from Twilio into a spooled buffer, waiting for it to become available"""
+        self._bind()
+        # The admin player/download routes may already have the MP3 on disk
+        cached_path = None
+        if fmt == "mp3":
+            try:
+                cached_path = get_cached_recording(recording_sid)
+            except RecordingNotFound:
+                pass
+        if cached_path:
+            try:
+                return await asyncio.to_thread(_copy_into_buffer, cached_path, f"{recording_sid}.mp3")
+            except FileNotFoundError:
+                pass  # evicted in the meantime
+
+        audio_url = recording_url(recording_sid, fmt)
+
+        retry_delay = 2  # seconds
+        for attempt in range(DOWNLOAD_MAX_RETRIES):
+            # Only hold a concurrency slot while actually talking to Twilio, not during backoff
+            async with self._semaphore:
+                start = time.perf_counter()
+                async with self._http.stream("GET", audio_url, auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)) as response:
+                    metrics.twilio_fetch_duration.observe(
+                        time.perf_counter() - start, "transcription", str(response.status_code)
+                    )
+                    if response.status_code == 200:
+                        return await _read_into_buffer(response, f"{recording_sid}.{fmt}")
+
+            if attempt < DOWNLOAD_MAX_RETRIES - 1:
+                metrics.recording_download_retries.inc()
+                print(f"Recording not ready yet (attempt {attempt + 1}/{DOWNLOAD_MAX_RETRIES}), retrying in {retry_delay}s...")
+                await asyncio.sleep(retry_delay)
+                retry_delay *= 2  # Exponential backoff
+
+        print(f"Failed to download recording after {DOWNLOAD_MAX_RETRIES} attempts: {recording_sid}")
+        return None
+
+
+engine = TranscriptionEngine(TRANSCRIPTION_CONCURRENCY)
+
+
+class AudioBuffer(NamedTuple):
+    """Downloaded recording, private to one job (no shared /tmp/{sid} path to race on)"""
+    filename: str
+    file: tempfile.SpooledTemporaryFile
+    size: int
+    sha256: str
+
+
+class _BufferWriter:
+    """Spools chunks while counting and hashing them"""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.buffer = tempfile.SpooledTemporaryFile(max_size=AUDIO_SPOOL_MAX_BYTES)
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > AUDIO_MAX_BYTES:
+            raise TranscriptionError(f"Recording exceeds {AUDIO_MAX_BYTES} bytes: {self.filename}", self.size)
+        self.digest.update(chunk)
+        self.buffer.write(chunk)
+
+    def finish(self) -> AudioBuffer:
+        self.buffer.seek(0)
+        return AudioBuffer(self.filename, self.buffer, self.size, self.digest.hexdigest())
+
+
+async def _read_into_buffer(response: httpx.Response, filename: str) -> AudioBuffer:
+    writer = _BufferWriter(filename)
+    try:
+        async for chunk in response.aiter_bytes():
+            writer.write(chunk)
+    except BaseException:
+        writer.buffer.close()
+        raise
+    return writer.finish()
+
+
+def _copy_into_buffer(path: str, filename: str) -> AudioBuffer:
+    writer = _BufferWriter(filename)
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b""):
+                writer.write(chunk)
+    except BaseException:
+        writer.buffer.close()
+        raise
+    return writer.finish()
+
+
+class TranscriptResult(NamedTuple):
+    """A finished transcription, waiting to be written by the job queue's write-behind buffer"""
+    kind: str  # "answer" | "message"
+    target_id: int
+    recording_sid: str
+    text: str
+    audio_bytes: int = 0
+    audio_duration: float = 0
+    processing_time: float = 0
+    audio_sha256: Optional[str] = None
+    cached: bool = False  # served from transcription_cache, no backend called
+    chunk_timings: Optional[str] = None  # JSON [{start, end, processing_time}] for split recordings
+    service: str = "openai_whisper"  # backend that produced the text (TranscriptionLog.service)
+    model_name: str = WHISPER_MODEL
+
+
+class CachedTranscript(NamedTuple):
+    text: str
+    audio_duration: float
+
+
+def lookup_cached_transcript(recording_sid: str, audio_sha256: str, model_name: str) -> Optional[CachedTranscript]:
+    db = SessionLocal()
+    try:
+        TC = models.TranscriptionCache
+        cutoff = datetime.utcnow() - timedelta(days=TRANSCRIPT_CACHE_TTL_DAYS)
+        row = db.query(TC.transcript_text, TC.audio_duration).filter(
+            TC.recording_sid == recording_sid,
+            TC.audio_sha256 == audio_sha256,
+            TC.model_name == model_name,
+            TC.language == WHISPER_LANGUAGE,
+            TC.created_at >= cutoff,
+        ).first()
+        return CachedTranscript(row[0], row[1] or 0) if row else None
+    finally:
+        db.close()
+
+
+def _store_cached_transcript(db: Session, r: TranscriptResult, now: datetime):
+    """Insert or refresh the cache entry for a result (a hit only bumps last_used_at)"""
+    TC = models.TranscriptionCache
+    dialect = db.get_bind().dialect.name
+    insert = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}.get(dialect)
+    if insert is None:
+        return  # no portable upsert; run without the cache
+
+    values = dict(
+        recording_sid=r.recording_sid, audio_sha256=r.audio_sha256, model_name=r.model_name, language=WHISPER_LANGUAGE,
+        transcript_text=r.text, audio_bytes=r.audio_bytes, audio_duration=r.audio_duration,
+        created_at=now, last_used_at=now,
+    )
+    refresh = {"last_used_at": now} if r.cached else {
+        "transcript_text": r.text, "audio_bytes": r.audio_bytes, "audio_duration": r.audio_duration, "created_at": now,
+        "last_used_at": now,
+    }
+    stmt = insert(TC).values(**values)
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=["recording_sid", "audio_sha256", "model_name", "language"], set_=refresh,
+    ))
+
+
+def prune_transcription_cache(db: Session) -> int:
+    """Drop entries older than TRANSCRIPT_CACHE_TTL_DAYS, then the least recently used beyond the row cap"""
+    TC = models.TranscriptionCache
+    cutoff = datetime.utcnow() - timedelta(days=TRANSCRIPT_CACHE_TTL_DAYS)
+    removed = db.query(TC).filter(TC.created_at < cutoff).delete(synchronize_session=False)
+    excess = db.query(func.count(TC.id)).scalar() - TRANSCRIPT_CACHE_MAX_ROWS
+    if excess > 0:
+        oldest = select(TC.id).order_by(TC.last_used_at).limit(excess).scalar_subquery()
+        removed += db.query(TC).filter(TC.id.in_(oldest)).delete(synchronize_session=False)
+    return removed
+
+
+def save_transcripts(db: Session, results: Sequence[TranscriptResult]):
+    """Apply finished transcripts, their success logs and cache entries to `db`; the caller commits"""
+    now = datetime.utcnow()
+    for r in results:
+        if r.audio_sha256:
+            _store_cached_transcript(db, r, now)
+
+    answer_ids = [r.target_id for r in results if r.kind == "answer"]
+    message_ids = [r.target_id for r in results if r.kind == "message"]
+    answers = {a.id: a for a in db.query(models.Answer).filter(models.Answer.id.in_(answer_ids))} if answer_ids else {}
+    messages = {m.id: m for m in db.query(models.Message).filter(models.Message.id.in_(message_ids))} if message_ids else {}
+
+    transitions = []
+    for r in results:
+        if r.kind == "message":
+            msg = messages.get(r.target_id)
+            if not msg:
+                continue
+            transitions.append((msg.call_sid, stats.message_status(msg.transcript_text), "completed"))
+            msg.transcript_text = r.text
+        else:
+            # Phase 2: Guard with recording_sid check to prevent mismatch
+            answer = answers.get(r.target_id)
+            if not answer or answer.recording_sid != r.recording_sid:
+                print(f"Warning: Answer mismatch or not found for id={r.target_id}, sid={r.recording_sid}")
+                continue
+
+            transitions.append((answer.call_sid, answer.transcript_status, "completed"))
+            answer.transcript_text = r.text
+            answer.transcript_status = "completed"
+
+        # Log success with Phase 2 details (chunk timings matter most for long messages)
+        db.add(models.TranscriptionLog(
+            answer_id=r.target_id if r.kind == "answer" else None,
+            message_id=r.target_id if r.kind == "message" else None,
+            service="transcription_cache" if r.cached else r.service,
+            status="success",
+            audio_bytes=r.audio_bytes,
+            audio_duration=int(r.audio_duration),
+            model_name=r.model_name,
+            language=WHISPER_LANGUAGE,
+            request_payload=f"file={r.recording_sid}.mp3",
+            response_payload=r.text[:1000] if r.text else "",
+            processing_time=int(r.processing_time),
+            chunk_timings=r.chunk_timings
+        ))
+
+    stats.transcript_transitions(db, transitions)
+
+
+def mark_answer_failed(answer_id: int, recording_sid: str, error: str, audio_bytes: int = 0,
+                       backend: Optional[TranscriptionBackend] = None):
+    """Record a transcription that will not be retried any more"""
+    db = SessionLocal()
+    try:
+        answer = db.query(models.Answer).filter(
+            models.Answer.id == answer_id,
+            models.Answer.recording_sid == recording_sid
+        ).first()
+
+        if answer:
+            stats.transcript_transitions(db, [(answer.call_sid, answer.transcript_status, "failed")])
+            answer.transcript_status = "failed"
+
+            log_entry = models.TranscriptionLog(
+                answer_id=answer_id,
+                service=backend.service if backend else "openai_whisper",
+                status="failed",
+                audio_bytes=audio_bytes,
+                model_name=backend.model_name if backend else WHISPER_MODEL,
+                request_payload=f"file={recording_sid}.mp3",
+                response_payload=error,
+                processing_time=0
+            )
+            db.add(log_entry)
+            db.commit()
+    finally:
+        db.close()
+
+
+def _save_message_transcript(message_id: int, transcript_text: str):
+    db = SessionLocal()
+    try:
+        msg = db.query(models.Message).filter(models.Message.id == message_id).first()
+        if msg:
+            stats.transcript_transitions(db, [(
+                msg.call_sid, stats.message_status(msg.transcript_text), stats.message_status(transcript_text)
+            )])
+            msg.transcript_text = transcript_text
+            db.commit()
+    finally:
+        db.close()
+
+
+def mark_message_failed(message_id: int, recording_sid: str, error: str, audio_bytes: int = 0,
+                        backend: Optional[TranscriptionBackend] = None):
+    _save_message_transcript(message_id, stats.MESSAGE_FAILED_TEXT)
+    db = SessionLocal()
+    try:
+        db.add(models.TranscriptionLog(
+            message_id=message_id,
+            service=backend.service if backend else "openai_whisper",
+            status="failed",
+            audio_bytes=audio_bytes,
+            model_name=backend.model_name if backend else WHISPER_MODEL,
+            request_payload=f"file={recording_sid}.mp3",
+            response_payload=error,
+            processing_time=0
+        ))
+        db.commit()
+    finally:
+        db.close()
+
+
+async def _download(recording_sid: str, fmt: str = "mp3") -> AudioBuffer:
+    audio = await engine.download_recording(recording_sid, fmt)
+    if audio is None:
+        raise TranscriptionError(f"Recording not available: {recording_sid}")
+    return audio
+
+
+def _scenario_backend(kind: str, target_id: int) -> Optional[str]:
+    """The transcription_backend override of the scenario the answer/message was recorded in"""
+    model = models.Answer if kind == "answer" else models.Message
+    db = SessionLocal()
+    try:
+        return db.query(models.Scenario.transcription_backend).join(
+            models.Call, models.Call.scenario_id == models.Scenario.id
+        ).join(model, model.call_sid == models.Call.call_sid).filter(model.id == target_id).scalar()
+    finally:
+        db.close()
+
+
+async def _cache_lookup(audio: AudioBuffer, recording_sid: str, force: bool,
+                        model_name: str) -> Optional[CachedTranscript]:
+    if force:
+        metrics.transcription_cache_requests.inc("bypass")
+        return None
+    cached = await asyncio.to_thread(lookup_cached_transcript, recording_sid, audio.sha256, model_name)
+    metrics.transcription_cache_requests.inc("hit" if cached else "miss")
+    return cached
+
+
+class _Transcript(NamedTuple):
+    text: str
+    audio_duration: float
+    processing_time: float
+    chunk_timings: Optional[str] = None
+
+
+async def _transcribe_whole(backend: TranscriptionBackend, audio: AudioBuffer, response_format: str) -> _Transcript:
+    start_time = time.time()
+    transcript = await backend.transcribe(audio, response_format=response_format)
+    return _Transcript(transcript.text, transcript.audio_duration, time.time() - start_time)
+
+
+async def _transcribe_chunked(backend: TranscriptionBackend, audio: AudioBuffer, response_format: str) -> _Transcript:
+    """Trim silence, split at pauses and transcribe the pieces concurrently (WAV input)"""
+    audio.file.seek(0)
+    try:
+        pcm = read_wav(audio.file.read())
+    except (wave.Error, ValueError, EOFError) as e:
+        print(f"Not splitting {audio.filename} ({e}); sending it whole")
+        return await _transcribe_whole(backend, audio, response_format)
+
+    chunks = await asyncio.to_thread(plan_chunks, pcm)
+    stem = audio.filename.rsplit(".", 1)[0]
+
+    async def run(i: int, chunk: Chunk):
+        start_time = time.time()
+        piece = AudioBuffer(f"{stem}_{i}.wav", io.BytesIO(chunk.wav), len(chunk.wav), "")
+        transcript = await backend.transcribe(piece, response_format="json")
+        return transcript.text.strip(), time.time() - start_time
+
+    start_time = time.time()
+    # The backend bounds how many chunks (across all jobs) run at once: API semaphore, local pool size
+    tasks = [asyncio.ensure_future(run(i, chunk)) for i, chunk in enumerate(chunks)]
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        # One failed chunk (or RateLimited) fails the job, which is retried whole: stop the siblings
+        # instead of letting them keep calling the backend in the background
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    timings = [
+        {"start": chunk.start, "end": chunk.end, "processing_time": round(elapsed, 3)}
+        for chunk, (_, elapsed) in zip(chunks, results)
+    ]
+    # Japanese has no spaces between sentences; silence-only recordings come back empty
+    text = "".join(text for text, _ in results)
+    return _Transcript(text, pcm.duration, time.time() - start_time, json.dumps(timings))
+
+
+async def _transcribe(kind: str, target_id: int, recording_sid: str, force: bool,
+                      duration: Optional[int], response_format: str) -> TranscriptResult:
+    backend = None
+    # Long recordings (Twilio's RecordingDuration) take the split path; Twilio serves them as WAV too
+    chunked = duration is not None and duration >= CHUNKED_MIN_SECONDS
+    audio = None
+    try:
+        backend = choose_backend(await asyncio.to_thread(_scenario_backend, kind, target_id), duration)
+        audio = await _download(recording_sid, "wav" if chunked else "mp3")
+        cached = await _cache_lookup(audio, recording_sid, force, backend.model_name)
+        if cached:
+            return TranscriptResult(
+                kind, target_id, recording_sid, cached.text,
+                audio.size, cached.audio_duration, 0, audio.sha256, cached=True,
+                service=backend.service, model_name=backend.model_name,
+            )
+
+        if chunked:
+            result = await _transcribe_chunked(backend, audio, response_format)
+        else:
+            result = await _transcribe_whole(backend, audio, response_format)
+        metrics.whisper_processing_time.observe(result.processing_time, kind, backend.name)
+        metrics.whisper_audio_bytes.observe(audio.size, kind, backend.name)
+    except TranscriptionError as e:
+        e.backend = e.backend or backend
+        raise
+    except Exception as e:
+        error = TranscriptionError(str(e), audio.size if audio else 0)
+        error.backend = backend
+        raise error from e
+    finally:
+        if audio:
+            audio.file.close()
+
+    print(f"Transcription completed for {recording_sid}: {result.text}")
+    return TranscriptResult(
+        kind, target_id, recording_sid, result.text,
+        audio.size, result.audio_duration, result.processing_time, audio.sha256,
+        chunk_timings=result.chunk_timings, service=backend.service, model_name=backend.model_name,
+    )
+
+
+async def transcribe_answer(answer_id: int, recording_sid: str, force: bool = False,
+                            duration: Optional[int] = None) -> TranscriptResult:
+    """Transcribe an answer recording, reusing a cached transcript of identical audio.
+
+    `force` skips the cache lookup (the fresh result still replaces the entry).
+    Recordings of `duration` >= TRANSCRIPTION_CHUNKED_MIN_SECONDS are split and
+    transcribed in parallel. Raises TranscriptionError on failure without
+    touching the answer status.
+    """
+    # verbose_json to get duration
+    return await _transcribe("answer", answer_id, recording_sid, force, duration, "verbose_json")
+
+
+async def transcribe_message(message_id: int, recording_sid: str, force: bool = False,
+                             duration: Optional[int] = None) -> TranscriptResult:
+    """Transcribe a message recording like an answer; raises TranscriptionError on failure"""
+    return await _transcribe("message", message_id, recording_sid, force, duration, "json")
@@ -0,0 +1,93 @@
+"""Write-behind buffer that turns many small result writes into a few batched transactions.
+
+Producers `await buffer.add(item)` and move on; a flusher task hands the
+accumulated items to `write_batch(items)` (run on a thread) once
+`batch_size` items are waiting or every `interval` seconds, whichever comes
+first. `add` blocks once `max_pending` items are queued so a stalled database
+applies backpressure instead of growing memory. `stop()` flushes whatever is
+left.
+"""
+import asyncio
+from typing import Callable, List, Sequence
+
+from . import metrics
+
+
+class WriteBehindBuffer:
+    def __init__(self, name: str, write_batch: Callable[[Sequence], None],
+                 batch_size: int, interval: float, max_pending: int):
+        self.name = name
+        self.write_batch = write_batch
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self.max_pending = max(self.batch_size, max_pending)
+        self._items: List = []
+        self._wakeup = None
+        self._space = None
+        self._flush_lock = None
+        self._closing = False
+        self._task = None
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Condition()
+        self._flush_lock = asyncio.Lock()
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    async def add(self, item):
+        if len(self._items) >= self.max_pending:
+            self._wakeup.set()
+            async with self._space:
+                await self._space.wait_for(lambda: len(self._items) < self.max_pending)
+        self._items.append(item)
+        if len(self._items) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self._items:
+                batch, self._items = self._items[:self.batch_size], self._items[self.batch_size:]
+                await asyncio.to_thread(self._write, batch)
+                async with self._space:
+                    self._space.notify_all()
+
+    async def stop(self):
+        """Stop the flusher after writing everything still buffered"""
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"{self.name} flush error: {e}")
+        await self.flush()
+
+    def _write(self, batch: Sequence):
+        metrics.write_behind_batch_size.observe(len(batch), self.name)
+        try:
+            self.write_batch(batch)
+            return
+        except Exception as e:
+            if len(batch) == 1:
+                print(f"{self.name}: dropped buffered write {batch[0]!r}: {e}")
+                return
+            print(f"{self.name}: batch of {len(batch)} failed ({e}), writing items one by one")
+
+        # Isolate the bad item so it doesn't take the rest of the batch down with it
+        for item in batch:
+            try:
+                self.write_batch([item])
+            except Exception as e:
+                print(f"{self.name}: dropped buffered write {item!r}: {e}")
@@ -0,0 +1,78 @@
+"""AES-encrypted ZIP archives generated as a stream of chunks.
+
+pyzipper writes each entry with a data descriptor when the target is not
+seekable, so the archive can be sent to the client while it is still being
+built; memory use is bounded by one compressed chunk instead of the whole file.
+"""
+import csv
+import io
+from typing import Iterable, Iterator, Tuple
+
+import pyzipper
+
+ZIP_PASSWORD = b"attendme"
+FLUSH_BYTES = 64 * 1024
+
+
+class ChunkSink(io.RawIOBase):
+    """Write-only, non-seekable file object that buffers output until drained (ZIP and Parquet writers stream through it)"""
+
+    def __init__(self):
+        self._chunks = []
+        self.pending = 0
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        data = bytes(b)
+        self._chunks.append(data)
+        self.pending += len(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        self.pending = 0
+        return data
+
+
+def stream_encrypted_zip(entries: Iterable[Tuple[str, Iterable[bytes]]]) -> Iterator[bytes]:
+    """Yield the bytes of an encrypted ZIP built from (filename, chunks) pairs.
+
+    `entries` may itself be a generator, so files can be added as they become available.
+    """
+    sink = ChunkSink()
+    with pyzipper.AESZipFile(sink, 'w', compression=pyzipper.ZIP_DEFLATED, encryption=pyzipper.WZ_AES) as zf:
+        zf.setpassword(ZIP_PASSWORD)
+        zf.setencryption(pyzipper.WZ_AES, nbits=256)
+
+        for filename, chunks in entries:
+            # Sizes aren't known up front, so always allow entries past 2 GiB
+            with zf.open(filename, 'w', force_zip64=True) as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    if sink.pending >= FLUSH_BYTES:
+                        yield sink.drain()
+            if sink.pending:
+                yield sink.drain()
+
+    yield sink.drain()
+
+
+def csv_chunks(rows: Iterable[list]) -> Iterator[bytes]:
+    """Encode CSV rows incrementally as UTF-8"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= FLUSH_BYTES:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
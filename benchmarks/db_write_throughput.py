@@ -0,0 +1,133 @@
+"""Concurrent write throughput: webhook inserts vs. background transcription commits.
+
+Usage:
+    python benchmarks/db_write_throughput.py
+    python benchmarks/db_write_throughput.py --postgres-url postgresql://user:pw@localhost/bench
+
+SQLite runs twice: with the old default journaling and with the WAL/busy_timeout
+tuning from app.database. Point --postgres-url at an empty scratch database;
+the app tables are created and dropped there.
+
+Webhook threads insert a Call, an Answer and its TranscriptionJob per
+transaction (what /twilio/record_callback does). Transcription threads update
+an Answer and insert a TranscriptionLog (what a finished job does). Reported
+per kind: committed transactions/s, p50/p99 commit latency and failed
+transactions ("database is locked" and friends).
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sqlalchemy.exc import OperationalError  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from app import models  # noqa: E402
+from app.database import Base, make_engine  # noqa: E402
+
+SEED_ANSWERS = 1000
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run(label, engine, webhook_threads, transcription_threads, seconds):
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine, autoflush=False)
+
+    seed = Session()
+    seed.add(models.Call(call_sid="CAseed", from_number="+810", to_number="+810", status="in-progress"))
+    seed.add_all(models.Answer(call_sid="CAseed", recording_sid=f"RE{i}") for i in range(SEED_ANSWERS))
+    seed.commit()
+    answer_ids = [a.id for a in seed.query(models.Answer.id)]
+    seed.close()
+
+    stop = threading.Event()
+    lock = threading.Lock()
+    latencies = {"webhook": [], "transcription": []}
+    failures = {"webhook": 0, "transcription": 0}
+
+    def webhook_write(db):
+        call_sid = f"CA{uuid.uuid4().hex}"
+        db.add(models.Call(call_sid=call_sid, from_number="+8180", to_number="+81901", status="in-progress"))
+        answer = models.Answer(call_sid=call_sid, recording_sid=f"RE{uuid.uuid4().hex}", transcript_status="processing")
+        db.add(answer)
+        db.flush()
+        db.add(models.TranscriptionJob(kind="answer", target_id=answer.id, recording_sid=answer.recording_sid, status="pending"))
+
+    def transcription_write(db):
+        answer_id = random.choice(answer_ids)
+        db.query(models.Answer).filter(models.Answer.id == answer_id).update(
+            {"transcript_text": "テスト" * 20, "transcript_status": "completed"}
+        )
+        db.add(models.TranscriptionLog(answer_id=answer_id, status="success", response_payload="テスト" * 20))
+
+    def worker(kind, write):
+        while not stop.is_set():
+            db = Session()
+            start = time.perf_counter()
+            try:
+                write(db)
+                db.commit()
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies[kind].append(elapsed)
+            except OperationalError:
+                db.rollback()
+                with lock:
+                    failures[kind] += 1
+            finally:
+                db.close()
+
+    threads = [threading.Thread(target=worker, args=("webhook", webhook_write)) for _ in range(webhook_threads)]
+    threads += [threading.Thread(target=worker, args=("transcription", transcription_write)) for _ in range(transcription_threads)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    for kind in ("webhook", "transcription"):
+        done = latencies[kind]
+        print(
+            f"{label:<16} {kind:<14} {len(done) / seconds:>9.1f} tx/s"
+            f"   p50 {_percentile(done, 50) * 1000:>7.1f} ms"
+            f"   p99 {_percentile(done, 99) * 1000:>7.1f} ms"
+            f"   failed {failures[kind]}"
+        )
+
+    Base.metadata.drop_all(engine)
+    engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--webhook-threads", type=int, default=8)
+    parser.add_argument("--transcription-threads", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--postgres-url", help="empty scratch Postgres database to benchmark as well")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, tune in (("sqlite-default", False), ("sqlite-wal", True)):
+            url = f"sqlite:///{os.path.join(tmp, label + '.db')}"
+            run(label, make_engine(url, tune_sqlite=tune), args.webhook_threads, args.transcription_threads, args.seconds)
+
+    if args.postgres_url:
+        run("postgres", make_engine(args.postgres_url), args.webhook_threads, args.transcription_threads, args.seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+"""Call-flow load generator with local Twilio and Whisper stand-ins.
+
+Usage:
+    python benchmarks/loadgen.py
+    python benchmarks/loadgen.py --callers 50 --calls 1000 --think-ms 2000 \\
+        --whisper-latency-ms 3000 --whisper-error-rate 0.05 --twilio-error-rate 0.1
+
+Starts two things on localhost:
+
+* a stand-in server for Twilio's recording media endpoint
+  (GET /2010-04-01/Accounts/{sid}/Recordings/{sid}.mp3 or .wav, the latter a
+  synthetic --recording-seconds long talk/pause pattern) and the Whisper API
+  (POST /v1/audio/transcriptions), each with configurable latency, jitter and
+  error rate. Twilio errors are 404s (recording not ready yet), Whisper errors
+  are 500s, so the app's retry paths get exercised;
+* the app itself under uvicorn, on a scratch SQLite database, with
+  TWILIO_API_BASE_URL and OPENAI_BASE_URL pointing at the stand-ins.
+
+Then N concurrent callers walk /twilio/voice -> /twilio/record_callback x
+questions -> /twilio/message_record -> /twilio/message_confirm, optionally
+pausing --think-ms between steps like a real caller speaking. Once every call
+has hung up the generator waits for the transcription queue to drain.
+
+Reported: per-endpoint p50/p95/p99 latency and errors, and transcription
+completion lag (webhook response for a recording -> Whisper stand-in answering
+for it), plus how many recordings never got a transcript.
+
+--target http://host:port drives an already running server instead; start it
+with the TWILIO_API_BASE_URL / OPENAI_BASE_URL printed at startup.
+"""
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+
+import numpy as np
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.audio import encode_wav  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+AUTH = ("admin", "attendme")
+TO_NUMBER = "+815000000000"
+ACCOUNT_SID = "ACloadgen"
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def _synthetic_speech(seconds: float, rate: int = 8000) -> bytes:
+    """Noise bursts separated by short pauses, loud enough to read as speech to app.audio"""
+    rng = np.random.default_rng(0)
+    parts, total = [], 0.0
+    while total < seconds:
+        talk, pause = rng.uniform(2, 6), rng.uniform(0.4, 1.0)
+        parts.append(rng.normal(0, 3000, int(talk * rate)))
+        parts.append(np.zeros(int(pause * rate)))
+        total += talk + pause
+    return encode_wav(np.clip(np.concatenate(parts), -32768, 32767).astype(np.int16), rate)
+
+
+class StandIns:
+    """Twilio recording media + Whisper transcription endpoints with injected latency and errors"""
+
+    def __init__(self, args):
+        self.args = args
+        self.audio = os.urandom(args.audio_kb * 1024)
+        self.wav = _synthetic_speech(args.recording_seconds)
+        self.whisper_done = {}  # recording SID -> monotonic time of the successful transcription
+        self.counts = defaultdict(int)
+        self.app = FastAPI()
+        self.app.get("/2010-04-01/Accounts/{account_sid}/Recordings/{filename}")(self.recording)
+        self.app.post("/v1/audio/transcriptions")(self.transcription)
+
+    async def _delay(self, latency_ms):
+        jitter = latency_ms * self.args.jitter
+        await asyncio.sleep(max(0.0, random.uniform(latency_ms - jitter, latency_ms + jitter)) / 1000)
+
+    async def recording(self, account_sid: str, filename: str):
+        await self._delay(self.args.twilio_latency_ms)
+        if random.random() < self.args.twilio_error_rate:
+            self.counts["twilio_errors"] += 1
+            return Response(status_code=404)
+        self.counts["twilio_ok"] += 1
+        if filename.endswith(".wav"):
+            return Response(content=self.wav, media_type="audio/x-wav")
+        return Response(content=self.audio, media_type="audio/mpeg")
+
+    async def transcription(self, request: Request):
+        form = await request.form()
+        upload = form["file"]
+        await upload.read()
+        await self._delay(self.args.whisper_latency_ms)
+        if random.random() < self.args.whisper_error_rate:
+            self.counts["whisper_errors"] += 1
+            return JSONResponse({"error": {"message": "stand-in failure", "type": "server_error"}}, status_code=500)
+
+        self.counts["whisper_ok"] += 1
+        # Chunks of a split recording are uploaded as {sid}_{n}.wav; the last one to finish counts
+        self.whisper_done[upload.filename.rsplit(".", 1)[0].split("_")[0]] = time.monotonic()
+        text = "テストの回答です。"
+        if form.get("response_format") == "verbose_json":
+            return {"text": text, "language": "japanese", "duration": 4.2, "segments": []}
+        return {"text": text}
+
+
+async def serve_standins(standins, port):
+    server = uvicorn.Server(uvicorn.Config(standins.app, host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    return server, task
+
+
+def spawn_app(port, standin_url, workdir, args):
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'loadgen.db')}",
+        RECORDING_CACHE_DIR=os.path.join(workdir, "recording_cache"),
+        TWILIO_ACCOUNT_SID=ACCOUNT_SID,
+        TWILIO_AUTH_TOKEN="loadgen",
+        TWILIO_API_BASE_URL=standin_url,
+        OPENAI_API_KEY="sk-loadgen",
+        OPENAI_BASE_URL=f"{standin_url}/v1",
+        CALL_RECORDING_MODE="twiml",
+    )
+    if args.workers:
+        env["TRANSCRIPTION_WORKERS"] = str(args.workers)
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL if args.quiet else None,
+    )
+
+
+async def wait_until_up(client, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise SystemExit("app did not come up")
+
+
+async def setup(client, questions):
+    scenario = (await client.post("/admin/scenarios/", auth=AUTH, json={
+        "name": f"loadgen {uuid.uuid4().hex[:6]}", "greeting_text": "こんにちは", "disclaimer_text": "録音します。"
+    })).json()
+    for i in range(questions):
+        await client.post("/admin/questions/", auth=AUTH, json={
+            "text": f"質問{i + 1}", "sort_order": i + 1, "scenario_id": scenario["id"]
+        })
+    await client.post("/admin/phone_numbers/", auth=AUTH, json={"to_number": TO_NUMBER, "scenario_id": scenario["id"]})
+    question_ids = (await client.get(f"/admin/scenarios/{scenario['id']}/questions", auth=AUTH)).json()
+    return scenario["id"], [q["id"] for q in question_ids]
+
+
+class Caller:
+    def __init__(self, client, args, latencies, errors, recorded):
+        self.client = client
+        self.args = args
+        self.latencies = latencies
+        self.errors = errors
+        self.recorded = recorded  # recording SID -> monotonic time its webhook returned
+
+    async def post(self, endpoint, url, data):
+        start = time.monotonic()
+        try:
+            response = await self.client.post(url, data=data)
+            ok = response.status_code < 400
+        except httpx.HTTPError:
+            ok = False
+        self.latencies[endpoint].append(time.monotonic() - start)
+        if not ok:
+            self.errors[endpoint] += 1
+        if self.args.think_ms:
+            await asyncio.sleep(self.args.think_ms / 1000)
+        return ok
+
+    async def recording(self, endpoint, url, call_sid):
+        recording_sid = f"RE{uuid.uuid4().hex}"
+        data = {"CallSid": call_sid, "RecordingSid": recording_sid, "RecordingDuration": int(self.args.recording_seconds),
+                "RecordingUrl": f"https://api.twilio.com/2010-04-01/Accounts/{ACCOUNT_SID}/Recordings/{recording_sid}"}
+        if await self.post(endpoint, url, data):
+            self.recorded[recording_sid] = time.monotonic()
+
+    async def call(self, scenario_id, question_ids):
+        call_sid = f"CA{uuid.uuid4().hex}"
+        if not await self.post("voice", "/twilio/voice", {"To": TO_NUMBER, "From": "+819000000000", "CallSid": call_sid}):
+            return
+        for q_id in question_ids:
+            await self.recording("record_callback", f"/twilio/record_callback?scenario_id={scenario_id}&q_curr={q_id}", call_sid)
+        await self.recording("message_record", f"/twilio/message_record?scenario_id={scenario_id}", call_sid)
+        await self.post("message_confirm", f"/twilio/message_confirm?scenario_id={scenario_id}", {"Digits": "2"})
+
+
+async def drain(client, timeout):
+    """Wait for the transcription queue to empty; returns (seconds waited, final stats)"""
+    start = time.monotonic()
+    stats = {}
+    while time.monotonic() - start < timeout:
+        stats = (await client.get("/admin/transcription_jobs/stats", auth=AUTH)).json()
+        if stats["pending"] == 0 and stats["running"] == 0:
+            break
+        await asyncio.sleep(0.5)
+    return time.monotonic() - start, stats
+
+
+def report(latencies, errors, elapsed, recorded, whisper_done, drain_seconds, stats, standins):
+    total = sum(len(v) for v in latencies.values())
+    print(f"\n{total} webhook requests in {elapsed:.1f}s ({total / elapsed:.1f} req/s)\n")
+    print(f"{'endpoint':<18}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for endpoint in ("voice", "record_callback", "message_record", "message_confirm"):
+        values = latencies[endpoint]
+        print(
+            f"{endpoint:<18}{len(values):>7}{errors[endpoint]:>8}"
+            f"{_percentile(values, 50) * 1000:>10.1f}{_percentile(values, 95) * 1000:>10.1f}{_percentile(values, 99) * 1000:>10.1f}"
+        )
+
+    lags = [whisper_done[sid] - t for sid, t in recorded.items() if sid in whisper_done]
+    missing = len(recorded) - len(lags)
+    print(f"\ntranscription lag (webhook -> transcript) over {len(lags)} recordings:")
+    print(f"  p50 {_percentile(lags, 50):.2f}s   p95 {_percentile(lags, 95):.2f}s   p99 {_percentile(lags, 99):.2f}s   max {max(lags, default=0):.2f}s")
+    print(f"  not transcribed: {missing}   queue drained in {drain_seconds:.1f}s after the last call")
+    if stats:
+        print(f"  jobs: completed {stats['completed']}  failed {stats['failed']}  pending {stats['pending']}  running {stats['running']}")
+    counts = standins.counts
+    print(f"  stand-ins: twilio {counts['twilio_ok']} ok / {counts['twilio_errors']} injected errors, "
+          f"whisper {counts['whisper_ok']} ok / {counts['whisper_errors']} injected errors")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--callers", type=int, default=20, help="concurrent callers")
+    parser.add_argument("--calls", type=int, default=200, help="total calls")
+    parser.add_argument("--questions", type=int, default=3)
+    parser.add_argument("--think-ms", type=float, default=0, help="pause between a caller's steps")
+    parser.add_argument("--twilio-latency-ms", type=float, default=150)
+    parser.add_argument("--twilio-error-rate", type=float, default=0.0)
+    parser.add_argument("--whisper-latency-ms", type=float, default=1500)
+    parser.add_argument("--whisper-error-rate", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.3, help="latency jitter as a fraction of the mean")
+    parser.add_argument("--audio-kb", type=int, default=64, help="size of each stand-in MP3 recording")
+    parser.add_argument("--recording-seconds", type=float, default=20,
+                        help="RecordingDuration reported for every recording (long ones take the split WAV path)")
+    parser.add_argument("--workers", type=int, help="TRANSCRIPTION_WORKERS for the spawned app")
+    parser.add_argument("--drain-timeout", type=float, default=300)
+    parser.add_argument("--target", help="drive an already running server instead of spawning one")
+    parser.add_argument("--app-port", type=int, default=8765)
+    parser.add_argument("--standin-port", type=int, default=8766)
+    parser.add_argument("--quiet", action="store_true", help="hide the spawned app's output")
+    args = parser.parse_args()
+
+    standins = StandIns(args)
+    standin_url = f"http://127.0.0.1:{args.standin_port}"
+    server, server_task = await serve_standins(standins, args.standin_port)
+    print(f"stand-ins on {standin_url}: TWILIO_API_BASE_URL={standin_url} OPENAI_BASE_URL={standin_url}/v1")
+
+    workdir = tempfile.TemporaryDirectory()
+    proc = None
+    if args.target:
+        base_url = args.target
+    else:
+        base_url = f"http://127.0.0.1:{args.app_port}"
+        proc = spawn_app(args.app_port, standin_url, workdir.name, args)
+
+    limits = httpx.Limits(max_connections=args.callers + 4)
+    try:
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+            await wait_until_up(client)
+            scenario_id, question_ids = await setup(client, args.questions)
+
+            latencies = defaultdict(list)
+            errors = defaultdict(int)
+            recorded = {}
+            semaphore = asyncio.Semaphore(args.callers)
+
+            async def one():
+                async with semaphore:
+                    await Caller(client, args, latencies, errors, recorded).call(scenario_id, question_ids)
+
+            start = time.monotonic()
+            await asyncio.gather(*(one() for _ in range(args.calls)))
+            elapsed = time.monotonic() - start
+
+            drain_seconds, stats = await drain(client, args.drain_timeout)
+            report(latencies, errors, elapsed, recorded, standins.whisper_done, drain_seconds, stats, standins)
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+        server.should_exit = True
+        await server_task
+        workdir.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
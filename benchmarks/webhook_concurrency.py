@@ -0,0 +1,113 @@
+"""Webhook throughput as the number of in-flight calls grows.
+
+Usage:
+    python benchmarks/webhook_concurrency.py
+    python benchmarks/webhook_concurrency.py --levels 1 8 32 128 --calls 400
+
+Runs the app in-process on a scratch SQLite database (or DATABASE_URL if set)
+through httpx's ASGI transport, so no server or Twilio account is needed.
+For each concurrency level, N simulated callers walk /twilio/voice ->
+/twilio/record_callback x questions -> /twilio/message_record ->
+/twilio/message_confirm. Requests/s should keep rising with concurrency
+instead of flattening at the single-caller rate, which is what happens when
+synchronous DB work runs on the event loop. Transcription workers are not
+started, so only the webhook path is measured.
+
+A scratch database on local SSD/tmpfs commits in microseconds and hides the
+difference; --commit-latency-ms adds a per-commit delay to model a network
+volume or managed database, where blocking commits dominate.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+_tmp = tempfile.TemporaryDirectory()
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_tmp.name, 'bench.db')}")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import httpx  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+from app.database import engine  # noqa: E402
+from app.main import app  # noqa: E402
+
+AUTH = ("admin", "attendme")
+QUESTIONS = 3
+
+
+async def setup(client):
+    scenario = (await client.post("/admin/scenarios/", auth=AUTH, json={
+        "name": "bench", "greeting_text": "こんにちは", "disclaimer_text": "録音します。"
+    })).json()
+    for i in range(QUESTIONS):
+        await client.post("/admin/questions/", auth=AUTH, json={
+            "text": f"質問{i + 1}", "sort_order": i + 1, "scenario_id": scenario["id"]
+        })
+    await client.post("/admin/phone_numbers/", auth=AUTH, json={
+        "to_number": "+815000000000", "scenario_id": scenario["id"]
+    })
+    questions = (await client.get(f"/admin/scenarios/{scenario['id']}/questions", auth=AUTH)).json()
+    return scenario["id"], [q["id"] for q in questions]
+
+
+async def simulate_call(client, scenario_id, question_ids, latencies):
+    call_sid = f"CA{uuid.uuid4().hex}"
+
+    async def post(url, data):
+        start = time.perf_counter()
+        response = await client.post(url, data=data)
+        latencies.append(time.perf_counter() - start)
+        response.raise_for_status()
+
+    await post("/twilio/voice", {"To": "+815000000000", "From": "+819000000000", "CallSid": call_sid})
+    for q_id in question_ids:
+        await post(f"/twilio/record_callback?scenario_id={scenario_id}&q_curr={q_id}", {
+            "CallSid": call_sid, "RecordingUrl": "http://example.invalid/r", "RecordingSid": f"RE{uuid.uuid4().hex}"
+        })
+    await post(f"/twilio/message_record?scenario_id={scenario_id}", {
+        "CallSid": call_sid, "RecordingUrl": "http://example.invalid/m", "RecordingSid": f"RE{uuid.uuid4().hex}"
+    })
+    await post(f"/twilio/message_confirm?scenario_id={scenario_id}", {"Digits": "2"})
+
+
+async def run_level(client, scenario_id, question_ids, concurrency, calls):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            await simulate_call(client, scenario_id, question_ids, latencies)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(calls)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"in-flight {concurrency:>4}   {len(latencies) / elapsed:>8.1f} req/s   p50 {p50 * 1000:>7.1f} ms   p99 {p99 * 1000:>7.1f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--calls", type=int, default=200, help="simulated calls per level")
+    parser.add_argument("--commit-latency-ms", type=float, default=0, help="extra delay per COMMIT")
+    args = parser.parse_args()
+
+    if args.commit_latency_ms:
+        event.listen(engine, "commit", lambda conn: time.sleep(args.commit_latency_ms / 1000))
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        scenario_id, question_ids = await setup(client)
+        for level in args.levels:
+            await run_level(client, scenario_id, question_ids, level, args.calls)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
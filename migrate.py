@@ -1,7 +1,13 @@
 import sqlite3
 import os
 
-db_path = "./app.db"
+database_url = os.getenv("DATABASE_URL", "sqlite:///./app.db")
+if not database_url.startswith("sqlite:///"):
+    # Postgres deployments start from the current schema via create_all at app startup
+    print("migrate.py only handles SQLite databases, nothing to do.")
+    exit()
+
+db_path = database_url[len("sqlite:///"):]
 
 if not os.path.exists(db_path):
     print("Database not found, models initialized via main app startup usually.")
@@ -17,6 +23,11 @@ try:
     print("- Added deleted_at to scenarios")
 except Exception as e:
     print(f"- Skipped scenarios: {e}")
+try:
+    c.execute("ALTER TABLE scenarios ADD COLUMN transcription_backend VARCHAR")
+    print("- Added transcription_backend to scenarios")
+except Exception as e:
+    print(f"- Skipped scenarios: {e}")
 
 print("Migrating Calls...")
 try:
@@ -68,7 +79,9 @@ cols = [
     ("language", "VARCHAR"),
     ("processing_time", "INTEGER"),
     ("request_payload", "TEXT"),
-    ("response_payload", "TEXT")
+    ("response_payload", "TEXT"),
+    ("chunk_timings", "TEXT"),
+    ("message_id", "INTEGER")
 ]
 
 for col, dtype in cols:
@@ -81,6 +94,7 @@ for col, dtype in cols:
 try:
     c.execute("CREATE INDEX IF NOT EXISTS ix_transcription_logs_id ON transcription_logs (id)")
     c.execute("CREATE INDEX IF NOT EXISTS ix_transcription_logs_answer_id ON transcription_logs (answer_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_transcription_logs_message_id ON transcription_logs (message_id)")
 except Exception as e:
     print(f"Index creation error: {e}")
 
@@ -101,6 +115,86 @@ try:
 except Exception as e:
     print(f"Index creation error: {e}")
 
+print("Migrating PhoneNumbers...")
+try:
+    c.execute("ALTER TABLE phone_numbers ADD COLUMN normalized_number VARCHAR")
+    print("- Added normalized_number to phone_numbers")
+except Exception as e:
+    print(f"- Skipped phone_numbers: {e}")
+
+# Backfill with the same rule as models.normalize_phone
+for (to_number,) in c.execute("SELECT to_number FROM phone_numbers WHERE normalized_number IS NULL").fetchall():
+    normalized = to_number.strip().replace(' ', '').replace('-', '').replace('(', '').replace(')', '')
+    if not normalized.startswith('+'):
+        normalized = '+' + normalized
+    c.execute("UPDATE phone_numbers SET normalized_number = ? WHERE to_number = ?", (normalized, to_number))
+
+try:
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_phone_numbers_normalized_number ON phone_numbers (normalized_number)")
+except Exception as e:
+    # Two rows normalize to the same number; resolve them in the dashboard and re-run
+    print(f"Index creation error: {e}")
+
+print("Migrating TranscriptionJobs...")
+try:
+    c.execute("ALTER TABLE transcription_jobs ADD COLUMN force BOOLEAN DEFAULT 0")
+    print("- Added force to transcription_jobs")
+except Exception as e:
+    print(f"- Skipped transcription_jobs: {e}")
+try:
+    c.execute("ALTER TABLE transcription_jobs ADD COLUMN batch_id INTEGER REFERENCES retranscription_batches(id)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_transcription_jobs_batch_id ON transcription_jobs (batch_id)")
+    print("- Added batch_id to transcription_jobs")
+except Exception as e:
+    print(f"- Skipped transcription_jobs: {e}")
+try:
+    c.execute("ALTER TABLE transcription_jobs ADD COLUMN recording_duration INTEGER")
+    print("- Added recording_duration to transcription_jobs")
+except Exception as e:
+    print(f"- Skipped transcription_jobs: {e}")
+
+for col, dtype in [("ended_at", "TIMESTAMP"), ("duration", "INTEGER")]:
+    try:
+        c.execute(f"ALTER TABLE calls ADD COLUMN {col} {dtype}")
+        print(f"- Added {col} to calls")
+    except Exception as e:
+        print(f"- Skipped calls: {e}")
+
+print("Adding updated_at for incremental exports...")
+for table, created in [("calls", "COALESCE(created_at, started_at)"), ("answers", "created_at"), ("messages", "created_at")]:
+    try:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN updated_at TIMESTAMP")
+        print(f"- Added updated_at to {table}")
+    except Exception as e:
+        print(f"- Skipped {table}: {e}")
+    c.execute(f"UPDATE {table} SET updated_at = {created} WHERE updated_at IS NULL")
+    c.execute(f"CREATE INDEX IF NOT EXISTS ix_{table}_updated_at ON {table} (updated_at)")
+
+print("Adding recording_duration to answers/messages...")
+for table, kind in [("answers", "answer"), ("messages", "message")]:
+    try:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN recording_duration INTEGER")
+        print(f"- Added recording_duration to {table}")
+    except Exception as e:
+        print(f"- Skipped {table}: {e}")
+    # Jobs still on record know the duration Twilio sent with the recording
+    try:
+        c.execute(f"""
+            UPDATE {table} SET recording_duration = (
+                SELECT MAX(j.recording_duration) FROM transcription_jobs j WHERE j.kind = '{kind}' AND j.target_id = {table}.id
+            ) WHERE recording_duration IS NULL
+        """)
+    except Exception as e:
+        print(f"- Skipped backfilling {table}: {e}")
+
+print("Indexing Calls...")
+try:
+    c.execute("CREATE INDEX IF NOT EXISTS ix_calls_started_at_call_sid ON calls (started_at, call_sid)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_calls_status_started_at ON calls (status, started_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_calls_duration ON calls (duration)")
+except Exception as e:
+    print(f"Index creation error: {e}")
+
 conn.commit()
 conn.close()
 print("Migration completed")